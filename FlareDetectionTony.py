@@ -1,9 +1,13 @@
 import numpy as np
+import pandas as pd
 import HopFinder
 import HOP
 import LC
 import LC_Set
+from Quiescent import quiescent_background_finder, quiescent_fixed_point # one implementation
+from Quiescent import hop_edges, CADENCE_DAYS
 import matplotlib.pyplot as plt
+import logging
 
 
 
@@ -13,78 +17,12 @@ def MET_to_MJD(MET,MJDREF=51910):
     return MET/86400 + MJDREF
 
 
-def quiescent_background_finder(sourcelightcurve, method='forward'):
-    # Determines the "quiescent background" of a given lightcurve
-    qui = sourcelightcurve
-    
-    if not hasattr(sourcelightcurve, "hops") or sourcelightcurve.hops is None:
-        quiescent_background = np.nanmean(qui.flux)
-        qui_err = np.sqrt(np.sum((np.array(qui.flux_error) ** 2) * (1 / len(qui.flux_error)) ** 2))
-        print('No flares detected initially, quiescent background is all bins')
-        return quiescent_background, qui_err
-
-    # Mask out flaring regions
-    mask = []
-    for hop in sourcelightcurve.hops:
-        start_idx = np.searchsorted(sourcelightcurve.time, hop.start_time)
-        end_idx = np.searchsorted(sourcelightcurve.time, hop.end_time)
-        if start_idx < end_idx:
-            mask.extend(range(start_idx, end_idx))
-
-    maskindices = np.array(mask)
-    
-    # Prevents deleting qui if the mask is empty.
-    if maskindices.size > 0:
-        qui.flux = np.delete(qui.flux, maskindices)
-        qui.time = np.delete(qui.time, maskindices)
-        qui.flux_error = np.delete(qui.flux_error, maskindices)
-
-    if qui.flux.size == 0:
-        print("All time bins were flaring. No quiescent background can be determined.")
-        return np.nan, np.nan
-
-    # Compute weighted average of non-flaring sections
-    baseaverage = []
-    weights = []
-    tempavg = []
-
-    if cadence_df['cadence'][0] == 'daily':
-        tdiff = 3
-    if cadence_df['cadence'][0] == 'weekly':
-        tdiff = 7
-    if cadence_df['cadence'][0] == 'monthly':
-        tdiff = 30
-
-
-    for i in range(len(qui.flux) - 1):
-        tempavg.append(qui.flux[i])
-
-        # Check for time gap or last element
-        if i == len(qui.flux) - 2 or (qui.time[i + 1] - qui.time[i] != tdiff):
-            if tempavg:
-                baseaverage.append(np.nanmean(tempavg))
-                weights.append(len(tempavg))
-            tempavg = []
-
-    # Computing Weighted Mean, putting failsafes to avoid empty averages.
-    if baseaverage and weights:
-        quiescent_background = np.average(baseaverage, weights=weights)
-    else:
-        quiescent_background = np.nan
-
-    qui_err = np.sqrt(np.sum((np.array(qui.flux_error) ** 2) * (1 / len(qui.flux_error)) ** 2)) if len(qui.flux_error) > 0 else 0
-
-    print(f"Quiescent Background: {quiescent_background}, Error: {qui_err}")
-    return quiescent_background, qui_err
-
-
-
 def LCTimeRange(sourcearray, timerangestart,timerangeend):
     # Takes a slice of a source array given the indices of a desired time range.
     sourcearray = sourcearray[timerangestart:timerangeend]
     return sourcearray
 
-def quiescent_flare_plot(cadence_df,sourcename=None,sourcenum=0,percent = 0.1, MJDREFI=51910, MJDREFF=7.428703703703703e-4,bkg_err = False, factor = 1,timerangestart=0,timerangeend=-1):
+def quiescent_flare_plot(cadence_df,sourcename=None,sourcenum=0,percent = 0.1, MJDREFI=51910, MJDREFF=7.428703703703703e-4,bkg_err = False, factor = 1,timerangestart=0,timerangeend=-1,max_iter=50):
     # Finds the quiescent background of a source, and finds all flares using that background as the threshold.
     SecsInDay = 86400
 
@@ -109,25 +47,14 @@ def quiescent_flare_plot(cadence_df,sourcename=None,sourcenum=0,percent = 0.1, M
 
     # Initializing the actual LightCurve object, as well as defining relevant parameters for our first Bayesian Analysis.
     sourcelightcurve = LC.LightCurve(time,photon_flux,errors,time_format='mjd',name=titlestring)
-    maxflux = np.max(photon_flux)
-    minflux =np.min(photon_flux)
-    delta_flux = maxflux - minflux
-    delta_flux_percent = delta_flux * percent
-    thresholdflux = minflux + delta_flux_percent
-
-
-    # Finding first set of flares using thresholdflux value.
-    sourcelightcurve.get_bblocks(gamma_value=0.05)
-    sourcelightcurve.find_hop(method = 'baseline', lc_edges ='add', baseline = thresholdflux)
-
-
-    # Finding quiescent background.
-    quiescent_background, qui_err = quiescent_background_finder(sourcelightcurve,'forward')
-
-
-    # Using quiescent background to find flares again.
-    sourcelightcurve = LC.LightCurve(time,photon_flux,errors,time_format='mjd')
-    sourcelightcurve.get_bblocks(gamma_value=0.05)
+    # Bayesian blocks once; quiescent background as fixed point of baseline -> hops -> background
+    # starting at min + percent * (max - min) (max_iter=1: one refinement, like before)
+    sourcelightcurve.get_bblocks(gamma_value=0.05, cache=True)
+    quiescent_background, qui_err, n_iter, converged = \
+        quiescent_fixed_point(sourcelightcurve, percent=percent, lc_edges='add', max_iter=max_iter)
+    logging.info(f'quiescent background after {n_iter} iterations, converged: {converged}')
+
+    # Flares above the quiescent background (same blocks).
     sourcelightcurve.find_hop(method = 'baseline', lc_edges ='add',baseline = quiescent_background)
 
     # Plotting the Lightcurve itself.
@@ -173,48 +100,73 @@ def plotting_anomalies(sourcelightcurve):
 
 
 
+FLUENCE_COLUMNS = ['source_name', 'start_time', 'end_time', 'bin_start', 'bin_end', 'n_bins',
+                   'flux_sum', 'mean_flux', 'peak_flux', 'fluence', 'duration',
+                   'background_counts', 'source_counts', 'mdp99']
+
+def bin_width(sourcelightcurve, cadence=None):
+    # bin width in days: cadence, or lc.cadence ('daily', 'weekly', 'monthly'), or median step
+    if cadence is None:
+        cadence = getattr(sourcelightcurve, 'cadence', None)
+    if isinstance(cadence, str):
+        return CADENCE_DAYS[cadence]
+    if cadence is None:
+        return np.median(np.diff(sourcelightcurve.time))
+    return cadence
+
+def fluence_table(sourcelightcurve, flares, COSI_bkg_rate=22, time='s', cadence=None,
+                  count_rate_factor=None, average_mu=0.3):
+    """
+    Fluence of all flares of a light curve (time in MJD) at once
+    flares: flare table (e.g. lc.find_hop(..., table=True) or quiescent_flare_population) or
+            list of Hopjects; bins of a flare are start_time < time < end_time (Hopject.iis)
+    Bin width (days) from cadence or the light curve's own cadence (see bin_width)
+    fluence = flux_sum * bin width (in s if time == 's', else in days)
+    duration [s], background_counts = COSI_bkg_rate * duration
+    count_rate_factor: COSI count rate per unit flux (e.g. LAT_Aeff * ph_ratio / ARM reduction),
+        gives source_counts = mean_flux * count_rate_factor * duration and mdp99 (ComputeMDP99),
+        otherwise both are np.nan
+    Returns pd.DataFrame with one row per flare (FLUENCE_COLUMNS)
+    """
+    lc = sourcelightcurve
+    starts, ends = hop_edges(flares)
+    bin_start = np.searchsorted(lc.time, starts, side='right')
+    bin_end = np.maximum(np.searchsorted(lc.time, ends, side='left'), bin_start)
+    n_bins = bin_end - bin_start
+    # segment reductions over [bin_start, bin_end) of all flares; reduceat of the interleaved
+    # start and end indices, every other result is a flare (flux padded for bin_end == len)
+    flux = np.append(np.asarray(lc.flux, dtype=float), 0.)
+    bounds = np.column_stack([bin_start, bin_end]).ravel()
+    empty = n_bins == 0
+    if len(bounds) > 0:
+        flux_sum = np.where(empty, 0., np.add.reduceat(flux, bounds)[::2])
+        peak_flux = np.where(empty, np.nan, np.maximum.reduceat(flux, bounds)[::2])
+    else:
+        flux_sum, peak_flux = np.zeros(0), np.zeros(0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_flux = flux_sum / n_bins
+    fluence = flux_sum * bin_width(lc, cadence) * (86400 if time == 's' else 1)
+    duration = (ends - starts) * 86400
+    background_counts = COSI_bkg_rate * duration
+    if count_rate_factor is None:
+        source_counts = np.full(len(starts), np.nan)
+    else:
+        source_counts = mean_flux * count_rate_factor * duration
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mdp99 = ComputeMDP99(source_counts, background_counts, average_mu)
+    return pd.DataFrame({'source_name': np.full(len(starts), lc.name, dtype=object),
+                         'start_time': starts, 'end_time': ends, 'bin_start': bin_start,
+                         'bin_end': bin_end, 'n_bins': n_bins, 'flux_sum': flux_sum,
+                         'mean_flux': mean_flux, 'peak_flux': peak_flux, 'fluence': fluence,
+                         'duration': duration, 'background_counts': background_counts,
+                         'source_counts': source_counts, 'mdp99': mdp99},
+                        columns=FLUENCE_COLUMNS)
+
 def fluence_integrator(hops_bl,sourcelightcurve, time = 's',COSI_bkg_rate=22):
-    if cadence_df == None:
-        raise TypeError('Cadence dataframe not initialized. Please initialize before running this function.')
-    flarestack=[0,0,0,0,0]
-    for i in range(0,len(hops_bl)):
-        # Performs the loop through each HOP object found using .find_hops().
-        temp = sourcelightcurve.flux[np.min(hops_bl[i].iis):np.max(hops_bl[i].iis)]
-
-        # Depending on the cadence, will find fluence values accordingly.
-        # Fluence is flux * duration, so the flux dataframe is multiplied by the cadence between bins.
-        if cadence_df['cadence'][0] == 'daily':
-            temp_sum = temp * 3
-        if cadence_df['cadence'][0] == 'weekly':
-            temp_sum = temp * 7
-        if cadence_df['cadence'][0] == 'monthly':
-            temp_sum = temp * 30
-
-        # Converts days into seconds. This condition is most likely redundant, but I'll keep it for future proofing.
-        if time == 's':
-            temp_sum = temp_sum * 86400
-        
-
-        # Determines the duration of the flares, based off of the difference between the start and end times in MJD.
-
-        duration = (hops_bl[i].end_time-hops_bl[i].start_time)*86400
-
-        # Finds the rough integral of the flare itself. This is why we multiplied each flux value by its associated time bin.
-        integral = np.sum(temp_sum)
-
-        # Background count calculation since we use cnts/s * s.
-        background_counts = COSI_bkg_rate * duration
-
-        # The total flux of the flare.
-        fluxsum = np.sum(temp)
-        
-
-        # Condition to check if we have run through the loop already.
-        if len(flarestack)<1:
-            flarestack = [sourcelightcurve.name,fluxsum,integral,duration,background_counts]
-        else:
-            flarestack = np.vstack((flarestack,[sourcelightcurve.name,fluxsum,integral,duration,background_counts]))
-    return flarestack
+    # Fluence of all HOP objects hops_bl (list or flare table), see fluence_table.
+    # Returns pd.DataFrame with name, fluxsum, integral (fluence), duration, background_counts.
+    table = fluence_table(sourcelightcurve, hops_bl, COSI_bkg_rate=COSI_bkg_rate, time=time)
+    return table[['source_name', 'flux_sum', 'fluence', 'duration', 'background_counts']]
 
 def ComputeMDP99(src_counts, bkg_counts, average_mu=0.3):
     # Computes the Minimum Detectable Polarization for a given source, using background counts and source counts.
@@ -8,34 +8,135 @@ class Hopject:
     ---------
     Segment in a light curve, i.e. a group of Bayesian blocks, that represent a flare ( HOP group)
     For definition of start, peak and end of the flare check out the LightCurve class
+
+    Only start, peak, end time, the light curve and the method are stored; everything else is
+    computed on first access: bins (one contiguous slice of lc, i.e. time, flux, flux_error
+    are views) and blocks of the hop are searched once and cached, derived quantities (dur,
+    asym, peak_flux, ...) are properties. Fit results (exp_*, gauss_*) only exist after a fit.
     '''
+    __slots__ = ('start_time', 'peak_time', 'end_time', 'lc', 'method',
+                 '_bin_start', '_bin_end', '_start_block', '_peak_block', '_end_block',
+                 'exp_tr', 'exp_td', 'exp_amp', 'exp_t0', 'exp_chisqr', 'exp_redchi',
+                 'exp_converged', 'gauss_amp', 'gauss_mu', 'gauss_sigma', 'gauss_chisqr',
+                 'gauss_redchi')
+
     def __init__(self, hop_params, lc, method=None): #e.g. Hopject(lc.get_hop_method[0], lc)
         self.start_time, self.peak_time, self.end_time = hop_params        
         self.lc = lc
-        self.z = lc.z
-        self.name = lc.name
-        self.telescope = lc.telescope
         self.method = method #e.g. half or flip
-        self.iis = np.where(np.logical_and(lc.time > self.start_time, 
-        								   lc.time < self.end_time))
-        self.time = lc.time[self.iis]
-        self.flux = lc.flux[self.iis]
-        self.flux_error = lc.flux_error[self.iis]
-        self.n_bins = len(self.time)
-        self.coverage = self.n_bins / (self.end_time - self.start_time)
-        self.n_blocks = lc.bb_i_end(self.end_time) - lc.bb_i_start(self.start_time) 
+        self._bin_start = None
+        self._start_block = None
+
+    @classmethod
+    def from_row(cls, row, lc):
+        """
+        Hopject as view onto one row of a flare table (see HopFinder.hop_table), e.g.
+            hops = [Hopject.from_row(row, lc) for row in table.to_dict('records')]
+        Bins and blocks are taken from the row, nothing is searched in the light curve
+        """
+        hop = cls((row['start_time'], row['peak_time'], row['end_time']), lc, row['method'])
+        hop._bin_start, hop._bin_end = row['bin_start'], row['bin_end']
+        hop._start_block, hop._peak_block, hop._end_block = \
+            row['start_block'], row['peak_block'], row['end_block']
+        return hop
+
+    #----------------------------------------------------------------------------------------------
+    def _bins(self):
+        # bins with start_time < time < end_time; time is sorted -> searchsorted, cached
+        if self._bin_start is None:
+            self._bin_start = int(np.searchsorted(self.lc.time, self.start_time, side='right'))
+            self._bin_end = max(int(np.searchsorted(self.lc.time, self.end_time, side='left')),
+                                self._bin_start)
+        return slice(self._bin_start, self._bin_end)
+
+    def _blocks(self):
+        # index of start, peak and end block (see LightCurve.bb_i_start, bb_i, bb_i_end), cached
+        if self._start_block is None:
+            self._start_block = self.lc.bb_i_start(self.start_time)
+            self._peak_block = self.lc.bb_i(self.peak_time)
+            self._end_block = self.lc.bb_i_end(self.end_time)
+        return self._start_block, self._peak_block, self._end_block
+
+    @property
+    def z(self):
+        return self.lc.z
+
+    @property
+    def name(self):
+        return self.lc.name
+
+    @property
+    def telescope(self):
+        return self.lc.telescope
+
+    @property
+    def iis(self):
+        # index of bins, as np.where(start_time < lc.time < end_time)
+        bins = self._bins()
+        return (np.arange(bins.start, bins.stop),)
+
+    @property
+    def time(self):
+        return self.lc.time[self._bins()]
+
+    @property
+    def flux(self):
+        return self.lc.flux[self._bins()]
+
+    @property
+    def flux_error(self):
+        return self.lc.flux_error[self._bins()]
+
+    @property
+    def n_bins(self):
+        bins = self._bins()
+        return bins.stop - bins.start
+
+    @property
+    def coverage(self):
+        return self.n_bins / (self.end_time - self.start_time)
+
+    @property
+    def n_blocks(self):
         # e.g. one-block hop: 5 - 3 = 2 
+        start_block, _, end_block = self._blocks()
+        return end_block - start_block
+
+    @property
+    def dur(self):
+        return self.end_time - self.start_time
+
+    @property
+    def rise_time(self):
+        return self.peak_time - self.start_time
+
+    @property
+    def decay_time(self):
+        return self.end_time - self.peak_time
+
+    @property
+    def asym(self):
+        return (self.rise_time - self.decay_time)/(self.rise_time + self.decay_time)
 
-        self.dur = self.end_time - self.start_time
-        self.rise_time = self.peak_time - self.start_time
-        self.decay_time = self. end_time - self. peak_time
-        self.asym = (self.rise_time - self.decay_time)/(self.rise_time + self.decay_time)
+    @property
+    def start_flux(self):
+        return self.lc.block_val[self._blocks()[0]]
 
-        self.start_flux = lc.block_val[lc.bb_i_start(self.start_time)]
-        self.peak_flux = lc.block_val[lc.bb_i(self.peak_time)]
-        self.end_flux = lc.block_val[lc.bb_i_end(self.end_time)]
-        self.rise_flux = self.peak_flux - self.start_flux
-        self.decay_flux = self.peak_flux - self.end_flux
+    @property
+    def peak_flux(self):
+        return self.lc.block_val[self._blocks()[1]]
+
+    @property
+    def end_flux(self):
+        return self.lc.block_val[self._blocks()[2]]
+
+    @property
+    def rise_flux(self):
+        return self.peak_flux - self.start_flux
+
+    @property
+    def decay_flux(self):
+        return self.peak_flux - self.end_flux
 
     #----------------------------------------------------------------------------------------------
     def plot_hop(self, ax=None, color='lightsalmon', alpha=0.2, label='hop', **kwargs):
@@ -118,3 +219,228 @@ class Hopject:
         ax.plot(x_plot,y_plot, marker='', zorder=13148, **plot_kwargs)
         return()
 
+
+
+#----------------------------------------------------------------------------------------------
+"""
+Batched exponential fit
+--------------------------------------------------------------------------
+Same model, weights (1/flux_error) and chi^2 as Hopject.get_exp_fit, but many flares are fitted
+at once with a vectorized Levenberg-Marquardt using the analytic Jacobian of exp_rd, instead of
+one lmfit Model with finite differences per flare.
+For example:
+    get_exp_fit_batch(hops)         # sets hop.exp_tr, hop.exp_td, ... and hop.exp_converged
+"""
+EXP_PARAMS = ['exp_amp', 'exp_t0', 'exp_tr', 'exp_td'] # order of parameters in fits
+
+def exp_rd_jac(t, amp, t_0, t_r, t_d):
+    """
+    exp_rd (see Hopject.exp_rd) and its derivatives with respect to amp, t_0, t_r, t_d
+    parameters may be arrays that broadcast with t, e.g. shape (n_flares, 1)
+    exp(-largest exponent) is factored out, so large |t - t_0| does not overflow
+    Returns model, jacobian (shape of model + (4,))
+    """
+    x_d = (t - t_0) / t_d
+    x_r = (t_0 - t) / t_r
+    x_max = np.maximum(x_d, x_r)
+    e_d = np.exp(x_d - x_max)
+    e_r = np.exp(x_r - x_max)
+    norm = np.exp(-x_max) / (e_d + e_r) # = 1 / (exp(x_d) + exp(x_r))
+    model = amp * norm
+    w_d = e_d / (e_d + e_r)
+    w_r = e_r / (e_d + e_r)
+    jac = np.stack([norm,
+                    model * (w_d / t_d - w_r / t_r),
+                    model * w_r * x_r / t_r,
+                    model * w_d * x_d / t_d], axis=-1)
+    return model, jac
+
+def levenberg_marquardt(t, y, weight, params, max_iter=200, ftol=1.5e-8, xtol=1.5e-8,
+                        gtol=1e-3):
+    """
+    Levenberg-Marquardt for exp_rd on padded arrays (n_flares, n_bins), weight = 0 for padding
+    Convergence like MINPACK (used by lmfit): an accepted step with relative decrease of
+    chi^2 <= ftol or relative step (scaled with the Jacobian) <= xtol; fits that stall (damping
+    above 1e10) or reach max_iter are not converged; a small step also needs a stationary point
+    (undamped Gauss-Newton decrease <= gtol * chi^2), otherwise the damping is reset
+    Returns params, chisqr, converged, n_iter
+    """
+    params = params.copy()
+    n = len(params)
+    lam = np.full(n, 1e-2)
+    nu = np.full(n, 2.)
+    converged = np.zeros(n, dtype=bool)
+    n_iter = np.zeros(n, dtype=int)
+    with np.errstate(all='ignore'):
+        model, jac = exp_rd_jac(t, *params.T[:, :, None])
+        res = (model - y) * weight
+        chisqr = np.sum(res**2, axis=1)
+        active = np.isfinite(chisqr)
+        for _ in range(max_iter):
+            a = np.flatnonzero(active)
+            if len(a) == 0:
+                break
+            J = jac[a] * weight[a][:, :, None]
+            JTJ = np.einsum('nli,nlj->nij', J, J)
+            grad = np.einsum('nli,nl->ni', J, res[a])
+            diag = np.diagonal(JTJ, axis1=1, axis2=2)
+            diag = np.maximum(diag, 1e-30 * np.max(diag, axis=1, keepdims=True) + 1e-300)
+            A = JTJ + (lam[a, None] * diag)[:, :, None] * np.eye(4)
+            try:
+                step = np.linalg.solve(A, -grad[:, :, None])[:, :, 0]
+            except np.linalg.LinAlgError:
+                step = np.einsum('nij,nj->ni', np.linalg.pinv(A), -grad)
+            trial = params[a] + step
+            model_t, jac_t = exp_rd_jac(t[a], *trial.T[:, :, None])
+            res_t = (model_t - y[a]) * weight[a]
+            chisqr_t = np.sum(res_t**2, axis=1)
+            better = np.isfinite(chisqr_t) & (chisqr_t <= chisqr[a])
+            actual = chisqr[a] - chisqr_t
+            predicted = (-2 * np.sum(step * grad, axis=1)
+                         - np.einsum('ni,nij,nj->n', step, JTJ, step))
+            small_f = (actual <= ftol * chisqr[a]) & (predicted <= ftol * chisqr[a])
+            scale = np.sqrt(diag)
+            small_x = (np.linalg.norm(scale * step, axis=1) 
+                       <= xtol * np.linalg.norm(scale * params[a], axis=1))
+            # accept better steps, otherwise increase damping
+            b = a[better]
+            params[b] = trial[better]
+            chisqr[b] = chisqr_t[better]
+            res[b] = res_t[better]
+            jac[b] = jac_t[better]
+            # damping update of Nielsen (1999) with gain ratio actual / predicted decrease
+            gain = actual[better] / np.maximum(predicted[better], 1e-300)
+            lam[b] = lam[b] * np.maximum(1/3, 1 - (2*np.minimum(gain, 1) - 1)**3)
+            nu[b] = 2
+            w = a[~better]
+            lam[w] = lam[w] * nu[w]
+            nu[w] = nu[w] * 2
+            n_iter[a] += 1
+            # stationary: the undamped Gauss-Newton step would decrease chi^2 by at most gtol
+            # (a tiny step with large damping is no proof of a minimum)
+            gs = grad / scale
+            gn = np.einsum('ni,nij,nj->n', gs,
+                           np.linalg.pinv(JTJ / (scale[:, :, None] * scale[:, None, :]),
+                                          rcond=1e-12), gs)
+            stationary = gn <= gtol * chisqr[a]
+            # converged: only an accepted step with small change at a stationary point; a
+            # small step elsewhere restarts with low damping; fits that stall (damping limit)
+            # or get invalid steps stop without convergence
+            finite = np.isfinite(step).all(axis=1)
+            small = finite & better & (small_f | small_x)
+            restart = a[small & ~stationary]
+            lam[restart], nu[restart] = 1e-2, 2
+            small = small & stationary
+            done = small | (lam[a] > 1e10) | ~finite
+            converged[a[small]] = True
+            active[a[done]] = False
+    return params, chisqr, converged, n_iter
+
+def fit_exp_batch(time, flux, flux_error, offsets, p0, max_iter=200, chunk_size=256):
+    """
+    Fit exp_rd to many flares at once
+    ragged input like bblocks_engine.py: flare i is [offsets[i]:offsets[i+1]] in time, flux,
+    flux_error; p0: initial (amp, t_0, t_r, t_d) of each flare, shape (n_flares, 4)
+    Flares are sorted by length and fitted in chunks of chunk_size flares (less padding)
+    Returns dict of arrays: exp_amp, exp_t0, exp_tr, exp_td, exp_chisqr, exp_redchi,
+    exp_converged, exp_n_iter
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    flux_error = np.asarray(flux_error, dtype=float)
+    offsets = np.asarray(offsets, dtype=int)
+    lengths = np.diff(offsets)
+    n = len(lengths)
+    params = np.array(p0, dtype=float).reshape(n, 4)
+    chisqr = np.full(n, np.nan)
+    converged = np.zeros(n, dtype=bool)
+    n_iter = np.zeros(n, dtype=int)
+    order = np.argsort(-lengths, kind='stable')
+    for c in range(0, n, chunk_size):
+        ii = order[c:c+chunk_size]
+        ii = ii[lengths[ii] > 0]
+        if len(ii) == 0:
+            continue
+        inside = np.arange(lengths[ii[0]]) < lengths[ii][:, None]
+        idx = offsets[ii][:, None] + np.where(inside, np.arange(lengths[ii[0]]), 0)
+        weight = np.where(inside, 1 / flux_error[idx], 0)
+        # fit time relative to initial t_0 (model only depends on t - t_0; well scaled steps)
+        t_ref = params[ii, 1].copy()
+        p = params[ii] - np.outer(t_ref, [0, 1, 0, 0])
+        p, chisqr[ii], converged[ii], n_iter[ii] = \
+            levenberg_marquardt(time[idx] - t_ref[:, None], flux[idx], weight, p, max_iter)
+        params[ii] = p + np.outer(t_ref, [0, 1, 0, 0])
+    fit = dict(zip(EXP_PARAMS, params.T))
+    fit['exp_chisqr'] = chisqr # $\chi^2 = \sum_i \frac{(O-C)^2}{\sigma_i^2}$
+    fit['exp_redchi'] = chisqr / np.maximum(1, lengths - 4) # as lmfit
+    fit['exp_converged'] = converged
+    fit['exp_n_iter'] = n_iter
+    return fit
+
+def get_exp_fit_batch(hops, max_iter=200):
+    """
+    Exponential fit (see Hopject.get_exp_fit) of all hops in one batch
+    initial guess from hops: amp=peak_flux, t_0=peak_time, t_r=rise_time, t_d=decay_time
+    Sets exp_tr, exp_td, exp_amp, exp_t0, exp_chisqr, exp_redchi and exp_converged of each hop
+    Returns dict of arrays, see fit_exp_batch
+    """
+    n_bins = [len(h.time) for h in hops]
+    offsets = np.concatenate([[0], np.cumsum(n_bins)]).astype(int)
+    p0 = [[h.peak_flux, h.peak_time, h.rise_time, h.decay_time] for h in hops]
+    fit = fit_exp_batch(np.concatenate([h.time for h in hops] + [np.zeros(0)]),
+                        np.concatenate([h.flux for h in hops] + [np.zeros(0)]),
+                        np.concatenate([h.flux_error for h in hops] + [np.zeros(0)]),
+                        offsets, np.reshape(p0, (len(hops), 4)), max_iter)
+    for i, hop in enumerate(hops):
+        for key in EXP_PARAMS + ['exp_chisqr', 'exp_redchi', 'exp_converged']:
+            setattr(hop, key, fit[key][i])
+    return fit
+
+
+#----------------------------------------------------------------------------------------------
+"""
+Fit-free flare shape
+--------------------------------------------------------------------------
+Closed-form estimate of the flare shape for all flares at once (microseconds per flare), e.g. to
+screen large flare populations and as initial guess of the exponential fit of good flares only
+"""
+EST_COLUMNS = ['est_amp', 'est_t0', 'est_tr', 'est_td', 'slope_tr', 'slope_td', 'est_ok']
+
+def estimate_shape(time, flux, offsets, start_time, peak_time, end_time, start_flux, peak_flux,
+                   end_flux, min_bins=4):
+    """
+    time, flux, offsets: bins of all flares (ragged, flare i is [offsets[i]:offsets[i+1]])
+    start/peak/end_time, start/peak/end_flux: arrays with one value per flare (see Hopject)
+    Returns dict of arrays:
+        est_tr, est_td: rise/decay time = flux-weighted mean distance of the bins before/after
+            peak_time, with flux above min(start_flux, end_flux) as weight
+            (= t_r, t_d of an exponential rise/decay that is covered by the hop)
+        slope_tr, slope_td: rise/decay time from the log-slope of the block fluxes
+            t_r = rise_time / ln(peak_flux/start_flux), t_d = decay_time / ln(peak_flux/end_flux)
+        est_amp, est_t0: 2*peak_flux, peak_time (exp_rd = peak_flux at the peak for t_r = t_d)
+        -> est_amp, est_t0, est_tr, est_td as initial guess of exp_rd (see fit_exp_batch)
+        est_ok: quality cut, at least min_bins bins and positive, finite est_tr and est_td
+    """
+    offsets = np.asarray(offsets, dtype=int)
+    lengths = np.diff(offsets)
+    n = len(lengths)
+    flare = np.repeat(np.arange(n), lengths)
+    start_time, peak_time, end_time, start_flux, peak_flux, end_flux = \
+        [np.asarray(a, dtype=float) for a in (start_time, peak_time, end_time, start_flux,
+                                              peak_flux, end_flux)]
+    dt = np.asarray(time, dtype=float) - peak_time[flare]
+    weight = np.maximum(np.asarray(flux, dtype=float) 
+                        - np.minimum(start_flux, end_flux)[flare], 0)
+    with np.errstate(all='ignore'):
+        rise = dt < 0
+        est_tr = (np.bincount(flare, np.where(rise, -dt * weight, 0), n) 
+                  / np.bincount(flare, np.where(rise, weight, 0), n))
+        decay = dt > 0
+        est_td = (np.bincount(flare, np.where(decay, dt * weight, 0), n) 
+                  / np.bincount(flare, np.where(decay, weight, 0), n))
+        slope_tr = (peak_time - start_time) / np.log(peak_flux / start_flux)
+        slope_td = (end_time - peak_time) / np.log(peak_flux / end_flux)
+    est_ok = ((lengths >= min_bins) & np.isfinite(est_tr) & np.isfinite(est_td) 
+              & (est_tr > 0) & (est_td > 0))
+    return {'est_amp': 2 * peak_flux, 'est_t0': peak_time, 'est_tr': est_tr, 'est_td': est_td,
+            'slope_tr': slope_tr, 'slope_td': slope_td, 'est_ok': est_ok}
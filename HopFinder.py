@@ -1,4 +1,5 @@
 import numpy as np 
+import pandas as pd
 #from lightcurves.LC import LightCurve
 from HOP import Hopject
 
@@ -13,6 +14,84 @@ WARNING:    sth unexpected happened
 ERROR:      sth didn't work, abort mission
 """ 
 
+#----------------------------------------------------------------------------------------------
+def block_extrema(block_val):
+    """
+    Index of peak blocks (previous rising; this falling) and valley blocks (previous falling;
+    this rising) from sign changes of np.diff(block_val)
+    """
+    diff = np.diff(block_val)
+    peak_ii = np.flatnonzero((diff[:-1] > 0) & (diff[1:] < 0)) + 1
+    valley_ii = np.flatnonzero((diff[:-1] < 0) & (diff[1:] > 0)) + 1
+    return peak_ii, valley_ii
+
+def baseline_crossings(block_val, edges, baseline):
+    """
+    start = edge where block_val goes above baseline; end = edge where it goes below baseline
+    A block equal to the baseline counts as below, so starts and ends always alternate
+    """
+    above = np.asarray(block_val) > baseline # as peaks of HopFinderBaseline
+    below = ~above
+    starts = edges[np.flatnonzero(below[:-1] & above[1:]) + 1]
+    ends = edges[np.flatnonzero(above[:-1] & below[1:]) + 1]
+    return starts, ends
+
+def block_centers(edges, ii):
+    # peak_time = middle of peak block
+    return edges[ii] + (edges[ii+1] - edges[ii]) /2
+
+HOP_COLUMNS = ['method', 'start_time', 'peak_time', 'end_time', 'bin_start', 'bin_end', 'n_bins',
+               'coverage', 'start_block', 'peak_block', 'end_block', 'n_blocks', 'dur',
+               'rise_time', 'decay_time', 'asym', 'start_flux', 'peak_flux', 'end_flux',
+               'rise_flux', 'decay_flux']
+
+def hop_table(lc, starts, peaks, ends, method=None):
+    """
+    Columnar flare table: one row per hop with the same quantities as a Hopject (see HOP.py),
+    computed for all hops of the light curve at once
+    bin_start, bin_end: bins of the hop are lc.time[bin_start:bin_end] (start < time < end)
+    start_block, peak_block, end_block: index of Bayesian blocks (lc.bb_i_start, bb_i, bb_i_end)
+    starts, peaks and ends are paired in order; if their lengths differ (e.g. a flat peak of
+    equal blocks is no peak), the surplus at the end is neglected, as zip(peaks, starts, ends)
+    Returns pd.DataFrame with columns HOP_COLUMNS (no rows if there are no hops)
+    """
+    n = min(len(starts), len(peaks), len(ends))
+    if not len(starts) == len(peaks) == len(ends):
+        logging.info('unpaired start/peak/end times, neglected ' +
+                     str(max(len(starts), len(peaks), len(ends)) - n) + ' at the end')
+    starts = np.asarray(starts, dtype=float)[:n]
+    peaks = np.asarray(peaks, dtype=float)[:n]
+    ends = np.asarray(ends, dtype=float)[:n]
+    # time is sorted and unique -> bins inside the hop are one contiguous slice
+    bin_start = np.searchsorted(lc.time, starts, side='right')
+    bin_end = np.maximum(np.searchsorted(lc.time, ends, side='left'), bin_start)
+    n_bins = bin_end - bin_start
+    start_block = lc.bb_i_start(starts)
+    peak_block = lc.bb_i(peaks)
+    end_block = lc.bb_i_end(ends)
+    dur = ends - starts
+    rise_time = peaks - starts
+    decay_time = ends - peaks
+    start_flux = lc.block_val[start_block]
+    peak_flux = lc.block_val[peak_block]
+    end_flux = lc.block_val[end_block]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coverage = n_bins / dur
+        asym = (rise_time - decay_time) / (rise_time + decay_time)
+    return pd.DataFrame({'method': np.full(len(peaks), method, dtype=object),
+                         'start_time': starts, 'peak_time': peaks, 'end_time': ends,
+                         'bin_start': bin_start, 'bin_end': bin_end, 'n_bins': n_bins,
+                         'coverage': coverage, 'start_block': start_block,
+                         'peak_block': peak_block, 'end_block': end_block,
+                         # e.g. one-block hop: 5 - 3 = 2
+                         'n_blocks': end_block - start_block, 'dur': dur,
+                         'rise_time': rise_time, 'decay_time': decay_time, 'asym': asym,
+                         'start_flux': start_flux, 'peak_flux': peak_flux,
+                         'end_flux': end_flux, 'rise_flux': peak_flux - start_flux,
+                         'decay_flux': peak_flux - end_flux}, columns=HOP_COLUMNS)
+
+
+#----------------------------------------------------------------------------------------------
 class HopFinder():
     """
     This is an abstract class that resembles an interface. i.e.
@@ -41,8 +120,11 @@ class HopFinder():
             single start and end times are neglected
             if peak has no start/end it is artificially added in beginning/end of light curve
 
-    returns: list of Hopjects, see HOP.py
+    returns: list of Hopjects, see HOP.py, or columnar table of all hops, see hop_table()
+    method: key of the method (see HOP_FINDERS), e.g. 'flip'; method column and Hopject.method
     """
+    method = None
+
     def __init__(self, lc_edges='neglect'):
         self.lc_edges = lc_edges
 
@@ -52,23 +134,26 @@ class HopFinder():
     def find_peaks(self, lc):
         raise NotImplementedError
 
-    def find(self, lc): 
+    def find(self, lc, table=False): 
+        """
+        table=False: list of Hopjects (None if there is no hop)
+        table=True: pd.DataFrame with one row per hop, see hop_table() (no rows if there is no hop)
+        """
         starts, ends = self.find_start_end(lc)
         peaks = self.find_peaks(lc)
         peaks, starts, ends = self.clean(peaks, starts, ends, lc)
+        if peaks is not None:
+            peaks, starts, ends = self.clean_multi_peaks(peaks, starts, ends, lc)
         if peaks is None:
             logging.info('no hop in this light curve')
+            if table:
+                return hop_table(lc, [], [], [], self.method)
             return None 
-        peaks, starts, ends = self.clean_multi_peaks(peaks, starts, ends, lc)
-        if peaks is None:
-            logging.info('no hop in this light curve')
-            return None 
-        hops = []
-        for p, s, e in zip(peaks, starts, ends):
-            #TBD hier könnte man noch Kriterien für hopject einfügen (e.g. bins per block/hop)
-            hops.append(Hopject((s,p,e), lc, method=type(self).__name__ ))
-            ## type(self).__name__ = Name der Klasse
-        return hops
+        hops = hop_table(lc, starts, peaks, ends, self.method)
+        #TBD hier könnte man noch Kriterien für hopject einfügen (e.g. bins per block/hop)
+        if table:
+            return hops
+        return [Hopject.from_row(row, lc) for row in hops.to_dict('records')]
 
     def clean(self, peaks, starts, ends, lc):
         """
@@ -80,7 +165,13 @@ class HopFinder():
             b) add:
                 single start and end times are neglected
                 peaks without start/end: start/end is added in beginning/end of light curve
+        peaks, starts, ends: sorted arrays (or lists) of times; edge handling only slices them
         """
+        peaks = np.asarray(peaks, dtype=float)
+        starts = np.asarray(starts, dtype=float)
+        ends = np.asarray(ends, dtype=float)
+        first_edge = lc.edges[:1].astype(float)
+        last_edge = lc.edges[-1:].astype(float)
         if len(peaks) < 1:
             logging.info('not variable enough, no peak found')
             return(None, None, None) 
@@ -90,42 +181,44 @@ class HopFinder():
                 return(None, None, None)
         if self.lc_edges == 'add':
             if len(starts) < 1:
-                starts = np.insert(starts, 0, lc.edges[0])
+                starts = first_edge
                 logging.info('inserted single start in beginning of LC')
             if len(ends) < 1:
-                ends = np.append(ends,lc.edges[-1])
+                ends = last_edge
                 logging.info('inserted single end in end of LC')
         if ends[0] < peaks[0]:
-            ends = np.delete(ends, 0)
+            ends = ends[1:]
             logging.info('deleted single end in beginning of LC')
             if len(ends) < 1 and self.lc_edges == 'neglect':
                 logging.info('this was the only end, not variable enough')
                 return(None, None, None)
             if len(ends) < 1 and self.lc_edges == 'add':
-                ends = np.append(ends, lc.edges[-1])
+                ends = last_edge
                 logging.info('inserted single end in end of LC and this is the only end')    
         if starts[-1] > peaks[-1]:
-            starts = np.delete(starts, -1)
+            starts = starts[:-1]
             logging.info('deleted single start in end of LC')
             if len(starts) < 1 and self.lc_edges == 'neglect':
                 logging.info('this was the only start, not variable enough')
                 return(None, None, None)
             if len(starts) < 1 and self.lc_edges == 'add':
-                starts = np.insert(starts, 0, lc.edges[0])
+                starts = first_edge
                 logging.info('inserted single start in beginning of LC; this is the only start')
         if peaks[0] < starts[0]:
             if self.lc_edges == 'add':
                 # artificially add start
-                starts = np.insert(starts, 0, lc.edges[0])
+                starts = np.concatenate([first_edge, starts])
                 logging.info('inserted single start in beginning of LC')
             if self.lc_edges == 'neglect':
-                # conservatively dismiss first peak if there are multiple peaks
-                while ends[0] > peaks[1]:
-                    peaks = np.delete(peaks, 0)
-                    logging.info('neglected first multiple peak in beginning of LC')
-                #conservatively dismiss first peak and first end
-                peaks = np.delete(peaks, 0)
-                ends = np.delete(ends, 0)
+                # conservatively dismiss first peak and all further peaks before the first end
+                # (peaks are sorted: count of peaks[1:] before ends[0])
+                n_drop = 1 + np.searchsorted(peaks[1:], ends[0], side='left')
+                if n_drop > 1:
+                    logging.info('neglected ' + str(n_drop - 1) + 
+                                 ' first multiple peak(s) in beginning of LC')
+                #conservatively dismiss first end
+                peaks = peaks[n_drop:]
+                ends = ends[1:]
                 logging.info('start missing, neglected peak and end in beginning of LC')
                 if len(peaks) < 1 or len(ends) < 1:
                     logging.info('this was the only peak or end, not variable enough')
@@ -133,17 +226,21 @@ class HopFinder():
         if peaks[-1] > ends[-1]:
             if self.lc_edges == 'add':
                 # artificially add end
-                ends = np.append(ends, lc.edges[-1])
+                ends = np.concatenate([ends, last_edge])
                 logging.info('inserted single end in end of LC') 
             if self.lc_edges == 'neglect':
-                # conservatively dismiss last peak if there are multiple peaks
+                # conservatively dismiss last peak and, if there are more than two peaks,
+                # all further peaks after the last start (count of peaks[:-1] after starts[-1])
+                n_drop = 1
                 if len(peaks) > 2:
-                    while starts[-1] < peaks[-2]:
-                        peaks = np.delete(peaks, -1)
-                        logging.info('neglected last multiple peak in end of LC')
-                    # conservatively dismiss last peak and last start
-                peaks = np.delete(peaks, -1)
-                starts = np.delete(starts, -1)
+                    n_drop += len(peaks) - 1 - np.searchsorted(peaks[:-1], starts[-1], 
+                                                               side='right')
+                    if n_drop > 1:
+                        logging.info('neglected ' + str(n_drop - 1) + 
+                                     ' last multiple peak(s) in end of LC')
+                # conservatively dismiss last start
+                peaks = peaks[:len(peaks) - n_drop]
+                starts = starts[:-1]
                 logging.info('neglected peak and start in end of LC')
                 if len(peaks) < 1 or len(starts) < 1:
                     logging.info('this was the only peak or start, not variable enough')
@@ -154,18 +251,31 @@ class HopFinder():
     def clean_multi_peaks(self, peaks, starts, ends, lc):
         # baseline method could result in multiple peaks within one HOP 
         # -> neglect smaller peak (not so senseful..)
-        while len(ends) < len(peaks):
-            for x,_ in enumerate(ends):
-                if ends[x] > peaks[x+1]:
-                    if (lc.block_val[lc.bb_i(peaks[x])] 
-                        < lc.block_val[lc.bb_i(peaks[x+1])]):
-                            peaks = np.delete(peaks, x)
-                    elif (lc.block_val[lc.bb_i(peaks[x])] 
-                          >= lc.block_val[lc.bb_i(peaks[x+1])]):
-                            peaks = np.delete(peaks, x+1)
-                    logging.info('neglected double peak in HOP ' + str(x))
-                    break
-        return peaks, starts, ends
+        n_merge = len(peaks) - len(ends)
+        if n_merge <= 0:
+            return peaks, starts, ends
+        peaks = np.asarray(peaks, dtype=float)
+        # single pass over sorted peaks and ends: hop x gets the next peak and all following peaks
+        # before ends[x], until there are as many peaks as ends (merged = number of neglected
+        # peaks up to hop x)
+        n_before = np.searchsorted(peaks, ends, side='left')
+        merged = np.maximum.accumulate(np.maximum(n_before - np.arange(len(ends)) - 1, 0))
+        merged = np.minimum(merged, n_merge)
+        group_end = np.arange(1, len(ends) + 1) + merged
+        group_start = np.concatenate([[0], group_end[:-1]])
+        if group_end[-1] < len(peaks):
+            logging.info('neglected ' + str(len(peaks) - group_end[-1]) + 
+                         ' peak(s) after the last end')
+        # keep highest peak block of each hop (first one if equal)
+        peak_val = lc.block_val[lc.bb_i(peaks[:group_end[-1]])]
+        group_size = group_end - group_start
+        group = np.repeat(np.arange(len(ends)), group_size)
+        is_max = peak_val == np.repeat(np.maximum.reduceat(peak_val, group_start), group_size)
+        candidates = np.flatnonzero(is_max)
+        _, first = np.unique(group[candidates], return_index=True)
+        for x in np.flatnonzero(group_size > 1):
+            logging.info('neglected ' + str(group_size[x] - 1) + ' double peak(s) in HOP ' + str(x))
+        return peaks[candidates[first]], starts, ends
 
 
 #----------------------------------------------------------------------------------------------
@@ -179,28 +289,17 @@ class HopFinderBaseline(HopFinder):
     lc.baseline: 
         e.g. mean of flux (default), median of flux, quiescent background ...
     """
+    method = 'baseline'
+
     def find_peaks(self, lc):
-        diff = np.diff(lc.block_val)
-        peaks = [] #time of all local peaks over baseline (in units of edges = units of time)
-        for i in range(1,len(diff)):
-            # if previous rising; this falling
-            if diff[i-1] > 0 and diff[i] < 0:
-                if lc.block_val[i] > lc.baseline:
-                    # peak_time = middle of peak block
-                    peaks.append(lc.edges[i] + (lc.edges[i+1] - lc.edges[i]) /2)
-        return peaks
+        # time of all local peaks over baseline (in units of edges = units of time)
+        peak_ii, _ = block_extrema(lc.block_val)
+        peak_ii = peak_ii[lc.block_val[peak_ii] > lc.baseline]
+        return block_centers(lc.edges, peak_ii)
 
     def find_start_end(self, lc):
-        starts = []  
-        ends = []    
-        for i in range(len(lc.block_val)-1):
-            # if this smaller; next one higher
-            if lc.block_val[i] < lc.baseline and lc.block_val[i+1] > lc.baseline:
-                starts.append(lc.edges[i+1])
-            # if this larger; next one lower
-            if lc.block_val[i] > lc.baseline and lc.block_val[i+1] < lc.baseline:
-                ends.append(lc.edges[i+1])
-        return starts, ends
+        # start: this smaller, next one higher than baseline; end: this larger, next one lower
+        return baseline_crossings(lc.block_val, lc.edges, lc.baseline)
 
 #----------------------------------------------------------------------------------------------
 class HopFinderProcedure(HopFinder):
@@ -214,30 +313,20 @@ class HopFinderProcedure(HopFinder):
 
     Determine peak_time of flare to be at center of colal maxima of the blocks
     Use self.change_point() to determine start and end_time depending on method             
+    change_point(edges, i) works for one valley block i or an array of valley blocks
     """
     def find_peaks(self, lc):
-        diff = np.diff(lc.block_val) # get_bblocks() needs to be done first
-        peaks = [] # time of all local peaks (units of edges, i.e. units of time)
-        for i in range(1,len(diff)):
-            # peak = previous rising; this falling
-            if diff[i-1] > 0 and diff[i] < 0:
-                # peak_time = middle of peak block
-                peaks.append(lc.edges[i] + (lc.edges[i+1] - lc.edges[i]) /2)
-        return peaks
+        # time of all local peaks (units of edges, i.e. units of time), get_bblocks() first
+        peak_ii, _ = block_extrema(lc.block_val)
+        return block_centers(lc.edges, peak_ii)
 
     def change_point(self, edges, i):
         raise NotImplementedError
 
     def find_start_end(self, lc):
-        starts = []
-        ends = []
-        diff = np.diff(lc.block_val) # get_bblocks() needs to be done first
-        for i in range(1,len(diff)):
-            # change = previous falling; this rising
-            if diff[i-1] < 0 and diff[i] > 0: 
-                start, end = self.change_point(lc.edges, i)
-                starts.append(start)
-                ends.append(end)
+        # change = previous falling; this rising, all valley blocks at once
+        _, valley_ii = block_extrema(lc.block_val) # get_bblocks() needs to be done first
+        starts, ends = self.change_point(lc.edges, valley_ii)
         return starts, ends
 
 #----------------------------------------------------------------------------------------------
@@ -245,6 +334,8 @@ class HopFinderHalf(HopFinderProcedure):
     """
     Determine start/end of flare to be at center of valley block
     """
+    method = 'half'
+
     def change_point(self, edges, i):
         half_block_time = (edges[i+1] - edges[i]) / 2
         return edges[i+1] - half_block_time, edges[i] + half_block_time
@@ -254,20 +345,119 @@ class HopFinderFlip(HopFinderProcedure):
     Extrapolate behavior of flare by flipping adjacent block onto valley block
     Note: half method is used to avoid overlap (i.e. when flip > 1/2 valley block)
     """
+    method = 'flip'
+
     def change_point(self, edges, i):
         half_block_time = (edges[i+1] - edges[i]) / 2
         #clap previous block onto change block
         clap_from_left = edges[i] - edges[i-1]
         #clap following block onto change block
         clap_from_right = edges[i+2] - edges[i+1]
-        e = edges[i] + min(half_block_time, clap_from_left)
-        s = edges[i+1] - min(half_block_time, clap_from_right)
+        e = edges[i] + np.minimum(half_block_time, clap_from_left)
+        s = edges[i+1] - np.minimum(half_block_time, clap_from_right)
         return s,e
 
 class HopFinderSharp(HopFinderProcedure):
     """
     Neglect valley block
     """
+    method = 'sharp'
+
     def change_point(self, edges, i):
         return edges[i+1], edges[i]
 
+
+
+#----------------------------------------------------------------------------------------------
+HOP_FINDERS = {'baseline': HopFinderBaseline, 'half': HopFinderHalf, 'flip': HopFinderFlip,
+               'sharp': HopFinderSharp}
+
+def find_all_hops(lc, lc_edges='neglect', baseline=None,
+                  methods=('baseline', 'half', 'flip', 'sharp')):
+    """
+    Find hops with all methods at once: peak and valley blocks are determined only once and
+    start/end times of all valleys are derived with array operations for each method
+    (clean() and clean_multi_peaks() as in HopFinder.find)
+    baseline: for baseline method, default is mean of flux (see LightCurve.find_hop)
+    Returns pd.DataFrame with columns HOP_COLUMNS (see hop_table()), method is e.g. 'flip'
+    """
+    edges = lc.edges
+    peak_ii, valley_ii = block_extrema(lc.block_val)
+    peak_times = block_centers(edges, peak_ii)
+    tables = []
+    for method in methods:
+        hopfinder = HOP_FINDERS[method](lc_edges)
+        if method == 'baseline':
+            if baseline is None:
+                baseline = np.mean(lc.flux)
+            peaks = peak_times[lc.block_val[peak_ii] > baseline]
+            starts, ends = baseline_crossings(lc.block_val, edges, baseline)
+        else:
+            peaks = peak_times
+            starts, ends = hopfinder.change_point(edges, valley_ii)
+        peaks, starts, ends = hopfinder.clean(peaks, starts, ends, lc)
+        if peaks is None:
+            logging.info('no hop in this light curve for method ' + method)
+            continue
+        peaks, starts, ends = hopfinder.clean_multi_peaks(peaks, starts, ends, lc)
+        tables.append(hop_table(lc, starts, peaks, ends, method))
+    if len(tables) == 0:
+        return hop_table(lc, [], [], [])
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == '__main__':
+    # check: block values equal to the baseline (e.g. baseline='median' or quantized flux)
+    # Run with: python HopFinder.py
+    from LC import LightCurve
+
+    def step_lc(levels, n=10, edges=None):
+        # light curve with n bins per level; Bayesian blocks = levels (or given edges)
+        flux = np.repeat(np.asarray(levels, dtype=float), n)
+        lc = LightCurve(np.arange(len(flux)) + 0.5, flux, np.full(len(flux), 0.1))
+        if edges is None:
+            lc.get_bblocks()
+        else:
+            lc.set_bblocks(edges)
+        return lc
+
+    # 1 -> 2 -> 4: start where 2 (on the baseline) goes to 4, not a start without end
+    lc = step_lc([1, 3, 1, 2, 4, 1])
+    assert np.array_equal(lc.block_val, [1, 3, 1, 2, 4, 1])
+    for lc_edges in ['neglect', 'add']:
+        table = lc.find_hop('baseline', lc_edges, baseline=2, table=True)
+        assert table[['start_time', 'peak_time', 'end_time']].values.tolist() == \
+               [[10, 15, 20], [40, 45, 50]], table
+        hops = lc.find_hop('baseline', lc_edges, baseline=2)
+        assert [(h.start_time, h.end_time) for h in hops] == [(10, 20), (40, 50)]
+    # flat peak of two equal blocks is no peak: unpaired starts are neglected as with zip
+    lc = step_lc([1, 3, 3, 1, 4, 1], edges=[0.5, 10, 20, 30, 40, 50, 59.5])
+    for lc_edges in ['neglect', 'add']:
+        table = lc.find_hop('baseline', lc_edges, baseline=2, table=True)
+        assert len(table) == 1 and table['peak_time'].iloc[0] == 45, table
+    print('baseline on block value: ok')
+
+    # check: find_all_hops gives the same hops as find_hop for each method, also with blocks
+    # on the baseline (step light curves, quantized simulations with baseline = median)
+    from bench_bblocks import simulate_lc
+    lcs = [step_lc([1, 3, 1, 2, 4, 1]), step_lc([2, 3, 2, 2, 4, 2, 1, 2]),
+           step_lc([1, 3, 3, 1, 4, 1], edges=[0.5, 10, 20, 30, 40, 50, 59.5])]
+    baselines = [2, 2, 2]
+    for seed in range(20):
+        time, flux, flux_error = simulate_lc(200, seed=seed)
+        q = (flux.max() - flux.min()) / 8
+        lc = LightCurve(time, np.round(flux / q) * q, flux_error)
+        lc.get_bblocks()
+        lcs.append(lc)
+        baselines.append(np.median(lc.flux))
+    n = 0
+    for lc, baseline in zip(lcs, baselines):
+        for lc_edges in ['neglect', 'add']:
+            all_hops = find_all_hops(lc, lc_edges, baseline)
+            for method in HOP_FINDERS:
+                table = lc.find_hop(method, lc_edges, baseline, table=True)
+                pd.testing.assert_frame_equal(
+                    all_hops[all_hops['method'] == method].reset_index(drop=True),
+                    table.reset_index(drop=True), check_dtype=False)
+                n += len(table)
+    print('find_all_hops = find_hop:', n, 'hops, ok')
@@ -2,10 +2,14 @@
 import numpy as np 
 from matplotlib import pyplot as plt
 import pickle
+import pandas as pd
 import astropy
 import astropy.stats.bayesian_blocks as bblocks
 #https://docs.astropy.org/en/stable/api/astropy.stats.bayesian_blocks.html
 from HopFinder import *
+from bblocks_engine import (segment_sum, cell_edges, change_points, ncp_prior, bblocks_dp_extend,
+                            bblocks_dp_sweep)
+import bblocks_cache
 
 import logging
 logging.basicConfig(level=logging.ERROR)
@@ -22,6 +26,7 @@ def load_lc_npy(path):
     """
     to load LCs that are saved as numpy array through pickle with lc.save_npy()
     ATTENTION: LC.py does not ge updated! 
+    -> see lc_store.py for a binary format that does not depend on LC.py
     """
     pickle_file = open(path, "rb") #open file and read bytes
     return pickle.load(pickle_file)
@@ -56,42 +61,72 @@ def fix_data(time, flux, flux_error):
     return(unique_time, good_flux, good_flux_error)
 
 
-def get_gti_iis(time, n_gaps, n_pick):
-    # get index of good time intervals (divide LC into secitons in case there are n_gaps gaps in data; like FACT)
-    # biggest time gaps (length in s) in chronological order
-    diff = np.array([t - s for s, t in zip(time, time[1:])])
-    diff1 = np.sort(diff)
-    ii = [x for x in range(len(diff)) if diff[x] in diff1[-n_gaps:]] #index of the 10 longest gaps
-    GTI_start_ii = np.array(ii)+1
-    GTI_start_ii = np.insert(GTI_start_ii,0,0)
-    GTI_end_ii = np.array(ii)
-    GTI_end_ii = np.append(GTI_end_ii, len(time)-1)
+def block_stats(time, flux, flux_error, edges):
+    """
+    Array-based block parameters for given Bayesian block edges (see LightCurve.get_bblocks)
+    edge_index: position of first bin with time >= edge
+    block_val: mean flux per block, block_val_error: Gaussian error propagation per block
+    block_pbin: same shape as flux, filled with corresponding block values
+    """
+    edge_index = np.searchsorted(time, edges, side='left')
+    #change last entry such that loop over [j:j+1] gives all blocks
+    edge_index[-1] += 1
+    n_bins = np.diff(edge_index)
+    block_val = segment_sum(flux, edge_index[:-1], n_bins) / n_bins
+    block_val_error = np.sqrt(segment_sum(flux_error**2, edge_index[:-1], n_bins)) / n_bins
+    block_pbin = np.repeat(block_val, n_bins)
+    return(block_pbin, block_val, block_val_error, edge_index)
+
+
+def largest_n(values, n):
+    """
+    Index (in chronological order) of the n largest values, found with a partial sort
+    Ties at the threshold are resolved deterministically: earlier index first
+    """
+    n = max(min(n, len(values)), 0)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    threshold = np.partition(values, len(values) - n)[len(values) - n] # n-th largest value
+    above = np.flatnonzero(values > threshold)
+    ties = np.flatnonzero(values == threshold)[:n - len(above)]
+    return np.sort(np.concatenate([above, ties]))
+
+def get_gti_iis(time, n_gaps=None, n_pick=None, min_gap=None):
+    """
+    get index of good time intervals (divide LC into sections in case there are gaps in data;
+    like FACT)
+    n_gaps: split at the n_gaps biggest time gaps (ties -> earlier gap)
+    min_gap: alternatively split at all gaps with length >= min_gap (in units of time)
+    n_pick: only consider the n_pick longest gtis (in number of bins; ties -> earlier gti)
+    Returns index of first and last bin of each gti in chronological order
+    """
+    diff = np.diff(time)
+    if min_gap is not None:
+        ii = np.flatnonzero(diff >= min_gap)
+    elif n_gaps is not None:
+        ii = largest_n(diff, n_gaps)
+    else:
+        raise ValueError('give either n_gaps or min_gap')
+    GTI_start_ii = np.concatenate([[0], ii + 1])
+    GTI_end_ii = np.concatenate([ii, [len(time) - 1]])
     if n_pick:
         # only consider the n_pick longest gtis 
-        gap_len = np.array([t - s for s,t in zip(GTI_start_ii, GTI_end_ii)])
-        gap_len1 = np.sort(gap_len)
-        ii = [x for x in range(len(gap_len)) if gap_len[x] in gap_len1[-n_pick:]] # n_gaps = considered gaps (longest not gaps)
-        GTI_start_ii_ = GTI_start_ii[ii]
-        GTI_end_ii_ = GTI_end_ii[ii]
-        return GTI_start_ii_, GTI_end_ii_
+        picked = largest_n(GTI_end_ii - GTI_start_ii, n_pick)
+        return GTI_start_ii[picked], GTI_end_ii[picked]
     else:
         return GTI_start_ii, GTI_end_ii
 
-def make_gti_lcs(lc, n_gaps, n_pick=None):
+def make_gti_lcs(lc, n_gaps=None, n_pick=None, min_gap=None):
     """
-    Divide one lc with n_gaps gaps into several lcs with good coverage.
+    Divide one lc with n_gaps gaps (or gaps >= min_gap) into several lcs with good coverage.
+    The chunks are views of lc (see LightCurve.__getitem__), i.e. no data is copied
+    Returns np.array of LightCurves (dtype=object)
     """
-    gti_starts, gti_ends = get_gti_iis(lc.time, n_gaps, n_pick)
-    if n_pick is None:
-        n_pick = n_gaps + 1 #select all 
-    chunks = []
-    for g in range(n_pick):
-        gti_lc = LightCurve(lc.time[gti_starts[g]:gti_ends[g]+1], 
-                            lc.flux[gti_starts[g]:gti_ends[g]+1], 
-                            lc.flux_error[gti_starts[g]:gti_ends[g]+1],
-                            name=lc.name, z=lc.z)
-        chunks.append(gti_lc)
-    return(np.array(chunks))
+    gti_starts, gti_ends = get_gti_iis(lc.time, n_gaps, n_pick, min_gap)
+    chunks = np.empty(len(gti_starts), dtype=object)
+    for g, (start, end) in enumerate(zip(gti_starts, gti_ends)):
+        chunks[g] = lc[int(start):int(end)+1]
+    return(chunks)
 
 
 #--------------------------------------------------------------------------------------------------
@@ -100,26 +135,48 @@ class LightCurve:
     Light Curve Class
     ------------------
     Create a light curve based on input data: time, flux, flux_error
+    time, flux, flux_error are rows (views) of one contiguous float64 buffer of shape (3, bins)
+    Slices (lc[i:ii], select_by_time) are views of the same buffer, i.e. no data is copied
+
+    validate: check for np.nan and duplicate times;
+              can be skipped for trusted data (e.g. views of a validated light curve)
+    copy: copy input into a new buffer; with copy=False float64 arrays are used as they are
     """
+    __slots__ = ('time', 'flux', 'flux_error', 'time_format', 'name', 'z', 'telescope',
+                 'cadence', 'edges', 'edge_index', 'block_val', 'block_val_error', 'block_pbin',
+                 'gamma_value', 'p0_value', 'dp_best', 'dp_last', 'dp_ncp_prior',
+                 'hops', 'baseline')
+
     def __init__(self, time, flux, flux_error, time_format=None, name=None, z=None, 
-                 telescope=None, cadence=None):
-        self.time = np.array(time)
-        self.flux = np.array(flux)
-        self.flux_error = np.array(flux_error)
+                 telescope=None, cadence=None, validate=True, copy=True):
+        if len(time) != len(flux) or len(time) != len(flux_error):
+            raise ValueError('Input arrays do not have same length')
+        if copy:
+            data = np.empty((3, len(time)))
+            data[0], data[1], data[2] = time, flux, flux_error
+            self.time, self.flux, self.flux_error = data
+        else:
+            self.time = np.asarray(time, dtype=float)
+            self.flux = np.asarray(flux, dtype=float)
+            self.flux_error = np.asarray(flux_error, dtype=float)
         self.time_format = time_format
         self.name = name
         self.z = z
         self.telescope = telescope
         self.cadence = cadence
-        if len(time) != len(flux) or len(time) != len(flux_error):
-            raise ValueError('Input arrays do not have same length')
-        if len(flux[np.isnan(flux)]) > 0 or len(flux_error[np.isnan(flux_error)]) > 0:
-            raise TypeError('flux or flux_error contain np.nan values')
-        if len(time) != len(np.unique(time)):
-            raise ValueError('time contains duplicate values')
-        if time_format:
-            """ format of the astropy.time.Time object """
-            self.astropy_time = astropy.time.Time(time, format=time_format)
+        if validate:
+            if np.isnan(self.flux).any() or np.isnan(self.flux_error).any():
+                raise TypeError('flux or flux_error contain np.nan values')
+            # sorted time is unique if strictly increasing (np.unique only if not sorted)
+            if (not np.all(np.diff(self.time) > 0)
+                and len(self.time) != len(np.unique(self.time))):
+                raise ValueError('time contains duplicate values')
+
+    @property
+    def astropy_time(self):
+        """ time as astropy.time.Time object in time_format (only created when needed) """
+        if self.time_format:
+            return astropy.time.Time(self.time, format=self.time_format)
 
     def __repr__(self):
         #this is everything you need to know about this instance (eg used for == method)
@@ -141,9 +198,11 @@ class LightCurve:
         if type(inbr) is int:
             return np.array([self.time[inbr], self.flux[inbr], self.flux_error[inbr]])
         elif type(inbr) is slice: 
+            # view of this light curve -> no copy and no validation needed
             return LightCurve(self.time[inbr], self.flux[inbr], 
                               self.flux_error[inbr], self.time_format, 
-                              self.name, self.z, self.telescope, self.cadence)
+                              self.name, self.z, self.telescope, self.cadence,
+                              validate=False, copy=False)
         elif type(inbr) is list:
             #can't be implemented with 'int or list' -> confusion with slice
             return np.array([self.time[inbr], self.flux[inbr], self.flux_error[inbr]])
@@ -223,23 +282,59 @@ class LightCurve:
         ax.grid(which='minor', **kwargs)
 
     #----------------------------------------------------------------------------------------------
-    def get_bblocks(self, gamma_value=None, p0_value=0.05): 
+    def get_bblocks(self, gamma_value=None, p0_value=0.05, engine='astropy', cache=None): 
         """
         Bayesian block algorithm (https://ui.adsabs.harvard.edu/abs/2013arXiv1304.2818S/abstract)
         fitness is set to 'measures' since we assume Gaussian error for flux measurements
         from astropy (https://docs.astropy.org/en/stable/api/astropy.stats.bayesian_blocks.html)
+        or engine='native' for the batched engine in bblocks_engine.py (same change points)
         Returns edges of blocks (significant changes of flux) in units of time (e.g. MJD)
         Edges are converted to edge_index (based on position in time array)
         -> See GitHub description and Jupyter Notebook for more information
         block_val are the flux values of all blocks based on the mean of all flux bins within
         block_val_error is the corresponding error computed with Gaussian error propagation
         block_pbin has the same shape as flux and is filled with corrsponding block values
+        cache: True (bblocks_cache.default_cache) or a bblocks_cache.BBlocksCache to reuse edges
+               of identical data and prior (e.g. from an earlier session)
         """
+        self.gamma_value = gamma_value
+        self.p0_value = p0_value
+        cache = bblocks_cache.get_cache(cache)
+        if cache is not None:
+            key = bblocks_cache.bblocks_key(self.time, self.flux, self.flux_error,
+                                            gamma_value, p0_value)
+            edges = cache.get(key)
+            if edges is not None:
+                logging.debug('got edges for light curve from cache')
+                return self.set_bblocks(edges)
+            blocks = self.get_bblocks(gamma_value, p0_value, engine)
+            cache.put(key, self.edges)
+            return blocks
         # get Bayesian block edges for light curve
-        self.edges = bblocks(t=self.time, x=self.flux, sigma=self.flux_error, fitness='measures',
-                             gamma=gamma_value, p0=p0_value)
+        if engine == 'native':
+            # keep state of dynamic program (dp_best, dp_last) for append()
+            prior = ncp_prior(len(self.time), p0_value, gamma_value)
+            best, last = bblocks_dp_extend(self.flux, self.flux_error, prior)
+            blocks = self.set_bblocks(cell_edges(self.time)[change_points(last)])
+            self.dp_best, self.dp_last, self.dp_ncp_prior = best, last, prior
+            logging.debug('got edges for light curve')
+            return blocks
+        elif engine == 'astropy':
+            edges = bblocks(t=self.time, x=self.flux, sigma=self.flux_error, fitness='measures',
+                            gamma=gamma_value, p0=p0_value)
+        else:
+            raise ValueError("engine has to be 'astropy' or 'native'")
         logging.debug('got edges for light curve')
+        return self.set_bblocks(edges)
 
+    def set_bblocks(self, edges, block_params=None):
+        """
+        Set Bayesian blocks from given edges, e.g. from get_bblocks() or bblocks_engine.py
+        block_params: (block_pbin, block_val, block_val_error, edge_index) if already computed
+        (e.g. bblocks_engine.bblocks_batch), else they are computed here
+        """
+        self.edges = np.asarray(edges, dtype=float) # sorted -> interval index, see bb_search()
+        self.dp_best, self.dp_last, self.dp_ncp_prior = None, None, None
         if len(self.edges) <= 2:
             logging.warning('light curve is constant; only one bayesian block found.')
             self.block_pbin = np.ones(len(self.flux)) * np.mean(self.flux)
@@ -249,29 +344,96 @@ class LightCurve:
             self.edges = np.array([self.time[0], self.time[-1]])
             return(self.block_pbin, self.block_val, self.block_val_error, self.edge_index,
                    self.edges)
-        # get edge_index
-        self.edge_index = np.array([np.where(self.time >= self.edges[i])[0][0] 
-                                    for i,_ in enumerate(self.edges)])
-        #change last entry such that loop over [j:j+1] gives all blocks
-        self.edge_index[-1] += 1
-
-        # determine flux value (mean) and error (Gaussian propagation) for each block
-        self.block_val = np.zeros(len(self.edge_index)-1)  
-        self.block_val_error = np.zeros(len(self.edge_index)-1) 
-        for j in range(len(self.edge_index)-1):
-            self.block_val[j] = np.mean(self.flux[self.edge_index[j]: self.edge_index[j+1]])
-            self.block_val_error[j] = (np.sqrt(np.sum(self.flux_error[self.edge_index[j]:
-                                                     self.edge_index[j+1]]**2))
-                                      / (self.edge_index[j+1]-self.edge_index[j]))
-
-        # create block-per-bin array corresponding to flux
-        self.block_pbin = np.zeros(len(self.flux))
-        for k,_ in enumerate(self.block_val):
-            self.block_pbin[self.edge_index[k] : self.edge_index[k+1]] = self.block_val[k]
+        if block_params is None:
+            block_params = block_stats(self.time, self.flux, self.flux_error, self.edges)
+        self.block_pbin, self.block_val, self.block_val_error, self.edge_index = block_params
         logging.debug('got block parameters for light curve')
 
         return(self.block_pbin, self.block_val, self.block_val_error, self.edge_index, self.edges)
 
+    #----------------------------------------------------------------------------------------------
+    def get_bblocks_sweep(self, p0_values=(), gamma_values=()):
+        """
+        Bayesian blocks for several false alarm settings in one pass (see bblocks_dp_sweep),
+        e.g. to check how stable the flare counts are:
+            for lc_p0 in lc.get_bblocks_sweep(p0_values=[0.01, 0.05, 0.1], gamma_values=[0.05]):
+                lc_p0.find_hop('flip')
+        Returns one LightCurve per setting (first p0_values, then gamma_values), each a view of
+        this light curve (no data is copied) with its own Bayesian blocks, gamma_value and p0_value
+        Edges are identical to get_bblocks() with the same setting.
+        """
+        settings = ([(None, p0) for p0 in p0_values]
+                    + [(gamma, 0.05) for gamma in gamma_values]) # gamma overrides p0
+        priors = [ncp_prior(len(self.time), p0, gamma) for gamma, p0 in settings]
+        best, last = bblocks_dp_sweep(self.flux, self.flux_error, priors)
+        all_edges = cell_edges(self.time)
+        sweep = []
+        for (gamma, p0), last_k in zip(settings, last):
+            lc_k = self[:]
+            lc_k.set_bblocks(all_edges[change_points(last_k)])
+            lc_k.gamma_value, lc_k.p0_value = gamma, p0
+            sweep.append(lc_k)
+        return sweep
+
+    #----------------------------------------------------------------------------------------------
+    def append(self, time, flux, flux_error):
+        """
+        Append new bins to the light curve (e.g. daily/weekly update of the LCR)
+        If Bayesian blocks were initialized, they are updated with the same gamma_value/p0_value:
+        the dynamic program is continued from its state (dp_best, dp_last) for the new bins only
+        and only the blocks after the last unchanged change point are recomputed
+        -> same result as get_bblocks() on the whole light curve
+        Note: the prior for p0 depends on the number of bins, i.e. each append changes it and the
+        dynamic program has to be recomputed -> use gamma_value for incremental updates
+        Note: hops need to be determined again with find_hop()
+        """
+        time = np.atleast_1d(time)
+        flux = np.atleast_1d(flux)
+        flux_error = np.atleast_1d(flux_error)
+        if len(time) != len(flux) or len(time) != len(flux_error):
+            raise ValueError('Input arrays do not have same length')
+        if len(flux[np.isnan(flux)]) > 0 or len(flux_error[np.isnan(flux_error)]) > 0:
+            raise TypeError('flux or flux_error contain np.nan values')
+        if time[0] <= self.time[-1] or np.any(np.diff(time) <= 0):
+            raise ValueError('appended time has to be sorted and after the light curve')
+        n_old = len(self.time)
+        data = np.empty((3, n_old + len(time)))
+        data[:, :n_old] = self.time, self.flux, self.flux_error
+        data[:, n_old:] = time, flux, flux_error
+        self.time, self.flux, self.flux_error = data
+        if not hasattr(self, 'edges'):
+            return self # no Bayesian blocks yet
+
+        prior = ncp_prior(len(self.time), self.p0_value, self.gamma_value)
+        incremental = self.dp_last is not None and prior == self.dp_ncp_prior
+        if incremental:
+            best, last = bblocks_dp_extend(self.flux, self.flux_error, prior,
+                                           self.dp_best, self.dp_last)
+        else:
+            logging.info('ncp_prior changed or no state of dynamic program; compute all bins')
+            best, last = bblocks_dp_extend(self.flux, self.flux_error, prior)
+        cps = change_points(last)
+
+        # blocks up to a change point that is in old and new solution stay the same
+        old_cps = self.edge_index
+        if incremental and len(old_cps) > 2:
+            m = np.max(np.intersect1d(cps, old_cps))
+            k = np.searchsorted(old_cps, m)
+        else:
+            m, k = 0, 0 # e.g. constant light curve before (block_val_error = std)
+        new_cps = cps[cps >= m]
+        n_bins = np.diff(new_cps)
+        block_val = segment_sum(self.flux, new_cps[:-1], n_bins) / n_bins
+        block_val_error = np.sqrt(segment_sum(self.flux_error**2, new_cps[:-1], n_bins)) / n_bins
+        self.set_bblocks(cell_edges(self.time)[cps],
+                         (np.concatenate([self.block_pbin[:m], np.repeat(block_val, n_bins)]),
+                          np.concatenate([self.block_val[:k], block_val]),
+                          np.concatenate([self.block_val_error[:k], block_val_error]), cps))
+        self.dp_best, self.dp_last, self.dp_ncp_prior = best, last, prior
+        logging.debug('appended ' + str(len(self.time) - n_old) + ' bins; '
+                      + str(len(block_val)) + ' blocks updated')
+        return self
+
     #----------------------------------------------------------------------------------------------
     def get_bblocks_above(self, threshold, pass_gamma_value=None, pass_p0_value=None):
         """
@@ -317,34 +479,48 @@ class LightCurve:
         Convert time to index of corresponding Bayesian block (e.g. block_value of peak_time)
         use bb_i_start/bb_i_end to make sure you get the block left/right outside of hop
         this works fine for flip, halfclap, and sharp but *NOT for BASELINE* (-> block inside hop)
+        t can be a single time or an array of times (-> array of block indices)
         """
-        if t == self.edges[0]:
-            return(int(0))
-        else:
-            block_index = [
-                e for e in range(len(self.edges)-1) if t > self.edges[e] and t <= self.edges[e+1]]
-            return(int(block_index[0]))
+        return self.bb_search(t, side='left', first_block=True)
 
     def bb_i_start(self,t):
         """
         if time = edge -> take block on the left
         ATTENTION: for baseline method this is first block of hop -> use bb_i() instead (works)
         """
-        block_index = [
-            e for e in range(len(self.edges)-1) if t >= self.edges[e] and t < self.edges[e+1]]
-        return(int(block_index[0]))
+        return self.bb_search(t, side='right')
 
     def bb_i_end(self,t):
         """
         if time = edge -> take block on the right
         ATTENTION: for baseline method this is last block of hop - use bb_i() instead (TBD)
         """
-        block_index = [
-            e for e in range(len(self.edges)-1) if t > self.edges[e] and t <= self.edges[e+1]]
-        return(int(block_index[0]))
+        return self.bb_search(t, side='left')
+
+    def bb_search(self, t, side='left', first_block=False):
+        """
+        Block interval index: edges are sorted, so block e = [edges[e], edges[e+1]] is found
+        with np.searchsorted for one time or an array of times at once
+        side='left':  edges[e] < t <= edges[e+1] (time = edge -> block on the left)
+        side='right': edges[e] <= t < edges[e+1] (time = edge -> block on the right)
+        first_block: t = edges[0] gives first block (for side='left')
+        """
+        t = np.asarray(t)
+        block_index = np.searchsorted(self.edges, t, side=side) - 1
+        if first_block:
+            block_index = np.where(t == self.edges[0], 0, block_index)
+        if np.any(block_index < 0) or np.any(block_index > len(self.edges) - 2):
+            raise IndexError('time is not within the Bayesian blocks of this light curve')
+        if block_index.ndim == 0:
+            return(int(block_index))
+        return block_index
     
     #----------------------------------------------------------------------------------------------
-    def find_hop(self, method='half', lc_edges='neglect', baseline=None):
+    def find_hop(self, method='half', lc_edges='neglect', baseline=None, table=False):
+        """
+        table=False: list of Hopjects (see HOP.py), table=True: pd.DataFrame with one row per hop
+        (see HopFinder.hop_table); also stored in self.hops
+        """
         if method == 'baseline':
             if baseline is None:
                 self.baseline = np.mean(self.flux)
@@ -357,19 +533,33 @@ class LightCurve:
             hopfinder = HopFinderSharp(lc_edges)
         if method == 'flip':
             hopfinder = HopFinderFlip(lc_edges)
-        self.hops = hopfinder.find(self)
+        self.hops = hopfinder.find(self, table)
         return self.hops
 
+    def find_all_hops(self, lc_edges='neglect', baseline=None,
+                      methods=('baseline', 'half', 'flip', 'sharp')):
+        """
+        All HOP methods in one pass (see HopFinder.find_all_hops)
+        Returns pd.DataFrame with one row per hop and method (see HopFinder.hop_table)
+        """
+        return find_all_hops(self, lc_edges, baseline, methods)
+
     #----------------------------------------------------------------------------------------------
-    def plot_hop(self, ax=None, **kwargs):
+    def plot_hop(self, ax=None, hops=None, **kwargs):
         """
         Plot shaded area for all hops in light curve
+        hops: default self.hops, or any hops with start_time and end_time
+              (e.g. list of Hopjects or table of find_hop(table=True) or find_all_hops())
         """
-        if self.hops is None:
+        if hops is None:
+            hops = self.hops
+        if hops is None:
             return # no hop in this lc
+        if isinstance(hops, pd.DataFrame):
+            hops = hops.itertuples()
         if ax is None:
             ax = plt.gca()
-        for i,hop in enumerate(self.hops):
+        for i,hop in enumerate(hops):
             x = np.linspace(hop.start_time, hop.end_time)
             y = np.ones(len(x)) * np.max(self.flux)
             y1 = np.min(self.flux)
@@ -392,30 +582,10 @@ class LightCurve:
         """
         fig = plt.figure(0,(15,9))
         plt.suptitle('All HOP methods', fontsize=16)
-
-        ax0 = fig.add_subplot(511)
-        self.find_hop('baseline')
-        self.plot_bblocks()
-        self.plot_hop()
-        plt.ylabel('baseline')
-
-        ax1 = fig.add_subplot(512)
-        self.find_hop('half')
-        self.plot_bblocks()
-        self.plot_hop()
-        plt.ylabel('half')
-
-        ax2 = fig.add_subplot(513)
-        self.find_hop('flip')
-        self.plot_bblocks()
-        self.plot_hop()
-        plt.ylabel('flip')
-
-        ax3 = fig.add_subplot(514)
-        self.find_hop('sharp')
-        self.plot_bblocks()
-        self.plot_hop()
-        plt.ylabel('sharp')
+        all_hops = self.find_all_hops(lc_edges=lc_edges)
+        for i, method in enumerate(['baseline', 'half', 'flip', 'sharp']):
+            fig.add_subplot(511 + i)
+            self.plot_bblocks()
+            self.plot_hop(hops=all_hops[all_hops['method'] == method].itertuples())
+            plt.ylabel(method)
         fig.subplots_adjust(hspace=0)
-
-
@@ -1,13 +1,183 @@
 import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, cached_property
 from matplotlib import pyplot as plt
 import astropy.visualization.hist as fancy_hist
 #https://docs.astropy.org/en/stable/api/astropy.visualization.hist.html
 from LC import LightCurve
-from HOP import Hopject
+from HOP import Hopject, fit_exp_batch, EXP_PARAMS, estimate_shape, EST_COLUMNS
+from bblocks_engine import get_bblocks_batch
+from HopFinder import HOP_FINDERS, HOP_COLUMNS
 import logging
 logging.basicConfig(level=logging.ERROR) #see LC.py
 
 
+EXP_COLUMNS = EXP_PARAMS + ['exp_chisqr', 'exp_redchi', 'exp_converged']
+
+def get_baseline(lc, baseline='mean'):
+    # baseline for hop_method='baseline': 'mean', 'median' of flux or a number
+    if baseline is None or baseline == 'mean':
+        return np.mean(lc.flux)
+    if baseline == 'median':
+        return np.median(lc.flux)
+    return baseline
+
+def hop_bins(table, lcs, first=0):
+    """
+    Bins of all hops in a flare table as ragged arrays: hop j is [offsets[j]:offsets[j+1]]
+    lcs: light curves of the hops (table['mom_lc'] - first is the index in lcs)
+    Returns time, flux, flux_error, offsets
+    """
+    bins = [(lcs[m - first], slice(s, e))
+            for m, s, e in zip(table['mom_lc'], table['bin_start'], table['bin_end'])]
+    offsets = np.concatenate([[0], np.cumsum(table['n_bins'])]).astype(int)
+    time = np.concatenate([lc.time[b] for lc, b in bins] + [np.zeros(0)])
+    flux = np.concatenate([lc.flux[b] for lc, b in bins] + [np.zeros(0)])
+    flux_error = np.concatenate([lc.flux_error[b] for lc, b in bins] + [np.zeros(0)])
+    return time, flux, flux_error, offsets
+
+def fit_hop_table(table, lcs, exp_fit='lmfit', first=0):
+    """
+    Exponential fit of the hops in a flare table (in place): adds EXP_COLUMNS (NaN if not
+    fitted) and exp_fitted, i.e. hops with more than 3 bins (exp_fit='screen': hops with est_ok)
+    exp_fit: 'batch', 'screen' or 'lmfit', see LC_Set
+    """
+    for key in EXP_COLUMNS:
+        table[key] = np.zeros(len(table), dtype=bool) if key == 'exp_converged' \
+            else np.full(len(table), np.nan)
+    if exp_fit == 'screen':
+        fitted = table['est_ok'].to_numpy(dtype=bool)
+    else:
+        fitted = table['n_bins'].to_numpy() > 3
+    table['exp_fitted'] = fitted
+    fitted = np.flatnonzero(fitted)
+    if len(fitted) == 0:
+        return table
+    rows = table.iloc[fitted]
+    if exp_fit in ['batch', 'screen']:
+        if exp_fit == 'screen':
+            p0 = rows[['est_amp', 'est_t0', 'est_tr', 'est_td']].to_numpy()
+        else:
+            p0 = rows[['peak_flux', 'peak_time', 'rise_time', 'decay_time']].to_numpy()
+        time, flux, flux_error, offsets = hop_bins(rows, lcs, first)
+        fit = fit_exp_batch(time, flux, flux_error, offsets, p0)
+        for key in EXP_COLUMNS:
+            table.loc[table.index[fitted], key] = fit[key]
+    elif exp_fit == 'lmfit':
+        for j, row in zip(fitted, rows.to_dict('records')):
+            hop = Hopject.from_row(row, lcs[row['mom_lc'] - first])
+            result = hop.get_exp_fit()
+            for key in EXP_COLUMNS[:-1]:
+                table.loc[table.index[j], key] = getattr(hop, key)
+            table.loc[table.index[j], 'exp_converged'] = result.success
+    return table
+
+def find_hops_chunk(lcs, first=0, hop_method='flip', lc_edges='neglect', baseline='mean',
+                    bblocks_engine=None, gamma_value=None, p0_value=0.05, exp_fit='lmfit',
+                    return_edges=False):
+    """
+    Hops of a chunk of light curves lcs (= lcs[first:first+len(lcs)] of an LC_Set), see LC_Set
+    This runs in the worker processes of LC_Set(n_workers > 1) and only returns compact records:
+    flare table: pd.DataFrame with one row per hop, columns of HopFinder.hop_table, mom_lc
+        (index in LC_Set), EST_COLUMNS (see HOP.estimate_shape) and, if exp_fit is not None,
+        EXP_COLUMNS and exp_fitted (see fit_hop_table)
+    edges: list of the edges of the Bayesian blocks of each lc if return_edges, else None
+    """
+    if bblocks_engine == 'native':
+        get_bblocks_batch(lcs, gamma_value=gamma_value, p0_value=p0_value)
+    elif bblocks_engine == 'astropy':
+        for lc in lcs:
+            lc.get_bblocks(gamma_value=gamma_value, p0_value=p0_value)
+    tables = []
+    for i, lc in enumerate(lcs):
+        try: 
+            lc.block_pbin
+        except AttributeError:
+            raise AttributeError('Initialize Bayesian blocks for all LCs first!')
+        logging.debug(str(first + i))
+        if hop_method == 'baseline':
+            lc.baseline = get_baseline(lc, baseline)
+        table = HOP_FINDERS[hop_method](lc_edges).find(lc, table=True)
+        if len(table) == 0:
+            logging.info(str(first + i) + ' no hop found; not variable enough')
+            continue #skip this lc
+        table['mom_lc'] = first + i
+        tables.append(table)
+    if len(tables) > 0:
+        table = pd.concat(tables, ignore_index=True)
+    else:
+        table = pd.DataFrame(columns=HOP_COLUMNS + ['mom_lc'])
+
+    # fit-free shape of all hops, directly on the bins of the light curves
+    time, flux, flux_error, offsets = hop_bins(table, lcs, first)
+    est = estimate_shape(time, flux, offsets, *[table[key].to_numpy(dtype=float) for key in 
+                         ['start_time', 'peak_time', 'end_time', 'start_flux', 'peak_flux',
+                          'end_flux']])
+    for key in EST_COLUMNS:
+        table[key] = est[key]
+    if exp_fit is not None:
+        fit_hop_table(table, lcs, exp_fit, first)
+    edges = [np.asarray(lc.edges) for lc in lcs] if return_edges else None
+    return table, edges
+
+def find_hops(lcs, first=0, n_workers=None, chunk_size=16, bblocks_engine=None, 
+              gamma_value=None, p0_value=0.05, **kwargs):
+    """
+    Flare table of all light curves lcs in chunks of chunk_size light curves, in this process
+    (n_workers None or 1) or in n_workers worker processes, see find_hops_chunk and LC_Set
+    first: index of lcs[0] (mom_lc of the hops)
+    Also sets lc.hops of all light curves in this process (see set_lc_hops)
+    """
+    find = partial(find_hops_chunk, bblocks_engine=bblocks_engine, gamma_value=gamma_value,
+                   p0_value=p0_value, **kwargs)
+    firsts = range(0, len(lcs), chunk_size)
+    chunks = [lcs[i:i+chunk_size] for i in firsts]
+    firsts = [first + i for i in firsts]
+    if n_workers is None or n_workers <= 1:
+        # light curves are changed in place (Bayesian blocks, baseline)
+        results = [find(chunk, i) for chunk, i in zip(chunks, firsts)]
+    else:
+        # workers only return flare tables (and edges of the Bayesian blocks)
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(partial(find, return_edges=bblocks_engine is not None),
+                                    chunks, firsts))
+        if bblocks_engine is not None:
+            for chunk, (_, edges) in zip(chunks, results):
+                for lc, e in zip(chunk, edges):
+                    lc.set_bblocks(e)
+                    lc.gamma_value, lc.p0_value = gamma_value, p0_value
+    if len(results) == 0:
+        return pd.DataFrame(columns=HOP_COLUMNS + ['mom_lc'] + EST_COLUMNS)
+    table = concat_tables([t for t, _ in results])
+    set_lc_hops(table, lcs, first)
+    return table
+
+def set_lc_hops(table, lcs, first=0):
+    # lc.hops of all light curves (as lc.find_hop: list of Hopjects or None) from the table rows
+    hops = [[] for lc in lcs]
+    for row in table.to_dict('records'):
+        i = int(row['mom_lc']) - first
+        hops[i].append(Hopject.from_row(row, lcs[i]))
+    for lc, h in zip(lcs, hops):
+        lc.hops = h if len(h) > 0 else None
+
+def concat_tables(tables):
+    # concatenate flare tables (empty tables have no dtypes and are skipped)
+    not_empty = [t for t in tables if len(t) > 0]
+    if len(not_empty) == 0:
+        return tables[0]
+    return pd.concat(not_empty, ignore_index=True)
+
+def table_column(key, table='table'):
+    # column of LC_Set.table (or LC_Set.exp_table) as np.array, computed on first access
+    def column(self):
+        return getattr(self, table)[key].to_numpy()
+    column.__name__ = key
+    column.__doc__ = key + ' of all hops (column of LC_Set.' + table + ')'
+    return cached_property(column)
+
+
 class LC_Set:
     '''
     Light Curve Set
@@ -50,71 +220,251 @@ class LC_Set:
 
     block_min: 
         Minimal number of blocks to be a flare, e.g. block_min = 2 -> no single-block flares
+
+    bblocks_engine:
+        None: Bayesian blocks have to be initialized for all lcs before (see above)
+        'native': get Bayesian blocks for all lcs in one batch, see bblocks_engine.py
+        'astropy': get Bayesian blocks with lc.get_bblocks() for each lc
+        with gamma_value and p0_value passed on (see LightCurve.get_bblocks)
+
+    exp_fit:
+        exponential fit of all hops with more than 3 bins (exp_tr, exp_td, ... of Hopjects)
+        'lmfit' (default): hop.get_exp_fit() for each hop
+        'batch': all hops of a chunk at once, see HOP.fit_exp_batch (also sets hop.exp_converged);
+                 much faster, but not identical to lmfit: some flares end in another local
+                 minimum (on simulations about 5% with chi^2 > 1% worse, 2% better)
+        'screen': only hops that pass the quality cut of the fit-free shape (est_ok, see
+                  HOP.estimate_shape) with the fit-free shape as initial guess
+        None: no fit
+        The fit-free shape of all hops is in est_amp, est_t0, est_tr, est_td, est_ok, ...
+
+    n_workers:
+        None or 1: all light curves in this process
+        n > 1: chunks of chunk_size light curves are processed by n worker processes (results
+        are in the order of lcs and do not depend on n_workers; with bblocks_engine, the
+        Bayesian blocks are computed in the workers and only their edges are sent back)
+    chunk_size:
+        number of light curves per chunk (one task of a worker, one batch of exponential fits)
+
+    lazy:
+        False: hop search (and exponential fit) in initialization
+        True: hop search only on first access of a hop attribute (e.g. plot_dur()) and
+              exponential fit only on first access of an exp_* attribute
+    All hops are in one flare table (self.table); hop attributes (dur, asym, exp_tr, ...,
+    hopjects) are computed from it on first access and memoized (see clear_cache)
     '''
-    def __init__(self, lcs, hop_method='flip', lc_edges='neglect', baseline='mean', block_min=1):
+    def __init__(self, lcs, hop_method='flip', lc_edges='neglect', baseline='mean', block_min=1,
+                 bblocks_engine=None, gamma_value=None, p0_value=0.05, exp_fit='lmfit',
+                 n_workers=None, chunk_size=16, lazy=False):
         # lc.get_bblock needs to be run already for each lc (do that in initialization)!!
-        # check weather get_bblockswas run for lc in lcs; return error if not
+        # or bblocks_engine is given (Bayesian blocks in find_hops_chunk, i.e. in the workers)
         self.lcs = lcs
-        mom_lc = []
-        hopjects = []
-
-        #make sure Bayesian blocks have been initialized before
-        for i,lc in enumerate(lcs):
-            try: 
-                lc.block_pbin
-            except AttributeError:
-                raise AttributeError('Initialize Bayesian blocks for all LCs first!')
-
-            logging.debug(str(i))
-            #optional: multiprocessing for hoparound of each lc here
-            if hop_method == 'baseline' and baseline == 'mean':
-                hops = lc.find_hop('baseline', np.mean(lc.flux), lc_edges)
-            elif hop_method == 'baseline':
-                hops = lc.find_hop('baseline', lc_edges)
-            elif hop_method == 'half':
-                hops = lc.find_hop('half', lc_edges)
-            elif hop_method == 'flip':
-                hops = lc.find_hop('flip', lc_edges)
-            elif hop_method == 'sharp':
-                hops = lc.find_hop('sharp', lc_edges)
-            if hops is None:
-                logging.info(str(i)+ ' no hop found; not variable enough')
-                continue #skip this lc
-            for hop in hops:
-                if len(hop.flux) > 3:
-                    hop.get_exp_fit()
-                hopjects.append(hop)
-                mom_lc.append(i)
-        self.n_blocks = np.array([h.n_blocks for h in hopjects])
-        mask = np.where(self.n_blocks > block_min)
+        self.hop_method = hop_method
+        self.lc_edges = lc_edges
+        self.baseline = baseline
+        self.block_min = block_min
+        self.bblocks_engine = bblocks_engine
+        self.gamma_value = gamma_value
+        self.p0_value = p0_value
+        self.exp_fit = exp_fit
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.lazy = lazy
+        self._subsets = {}
+        if not lazy:
+            self.table
+
+    #----------------------------------------------------------------------------------------------
+    @cached_property
+    def table(self):
+        """
+        Flare table: pd.DataFrame with one row per hop (with more than block_min blocks) of all
+        light curves, see find_hops_chunk; z is the redshift of the light curve (mom_lc)
+        All hop attributes of LC_Set (dur, asym, ..., hopjects) are computed from this table on
+        first access. With lazy=True, also the hop search only runs on first access.
+        """
+        return self.find_table(self.lcs, exp_fit=None if self.lazy else self.exp_fit)
+
+    def find_table(self, lcs, first=0, exp_fit=None):
+        """
+        Flare table of light curves lcs (mom_lc starts at first) with the settings of this LC_Set
+        """
+        table = find_hops(lcs, first=first, n_workers=self.n_workers, chunk_size=self.chunk_size,
+                          hop_method=self.hop_method, lc_edges=self.lc_edges,
+                          baseline=self.baseline, bblocks_engine=self.bblocks_engine,
+                          gamma_value=self.gamma_value, p0_value=self.p0_value, exp_fit=exp_fit)
         # eg one-block hop: n_blocks = end_block - start_block 
         #                            = 5 - 3 = 2 !> 2 (minimum blocks of hop)
+        table = table[table['n_blocks'].to_numpy() > self.block_min].reset_index(drop=True)
+        z = np.array([np.nan if lc.z is None else lc.z for lc in lcs], dtype=float)
+        table['z'] = z[table['mom_lc'].to_numpy(dtype=int) - first]
+        return table
+
+    @cached_property
+    def exp_table(self):
+        """
+        Flare table with exponential fit (EXP_COLUMNS), the fit runs on first access if it was
+        not done in the hop search (lazy=True or exp_fit=None -> 'lmfit')
+        """
+        if 'exp_fitted' not in self.table:
+            fit_hop_table(self.table, self.lcs, self.exp_fit or 'lmfit')
+            if 'hopjects' in self.__dict__:
+                self.set_exp_fit(self.hopjects)
+        return self.table
+
+    @cached_property
+    def hopjects(self):
+        """
+        Hopjects as views onto the rows of the flare table (no data is searched or copied)
+        """
+        hopjects = np.empty(len(self.table), dtype=object)
+        for i, row in enumerate(self.table.to_dict('records')):
+            hopjects[i] = Hopject.from_row(row, self.lcs[row['mom_lc']])
+        self.set_exp_fit(hopjects)
+        return hopjects
+
+    def set_exp_fit(self, hopjects):
+        # exp_tr, ... of fitted hopjects (if the fit was done)
+        if 'exp_fitted' not in self.table:
+            return
+        fitted = self.table['exp_fitted'].to_numpy(dtype=bool)
+        for key in EXP_COLUMNS:
+            values = self.table[key].to_numpy()
+            for i in np.flatnonzero(fitted):
+                setattr(hopjects[i], key, values[i])
+
+    def clear_cache(self, keep_table=False):
+        """
+        Forget all memoized attributes (table, hopjects, dur, ...), e.g. after changing lcs
+        keep_table: only forget attributes derived from the flare table
+        """
+        for key in list(self.__dict__):
+            if keep_table and key == 'table':
+                continue
+            if isinstance(getattr(type(self), key, None), cached_property):
+                del self.__dict__[key]
+        self._subsets = {}
+
+    def set_table(self, table):
+        # new flare table, derived attributes are computed again on first access
+        self.clear_cache(keep_table=True)
+        self.__dict__['table'] = table.reset_index(drop=True)
+
+    #----------------------------------------------------------------------------------------------
+    def add(self, lcs):
+        """
+        Add light curves (hops are searched with the settings of this LC_Set only in lcs)
+        Returns self, e.g. lc_set.add([lc_new]).plot_dur()
+        """
+        lcs = list(lcs)
+        first = len(self.lcs)
+        self.lcs = list(self.lcs) + lcs
+        if 'table' not in self.__dict__:
+            return self # lazy, nothing searched yet
+        fitted = 'exp_fitted' in self.table
+        table = self.find_table(lcs, first, (self.exp_fit or 'lmfit') if fitted else None)
+        self.set_table(concat_tables([self.table, table]))
+        return self
+
+    def remove(self, names):
+        """
+        Remove light curves (and their hops) by name, mom_lc of the other hops is updated
+        Returns self
+        """
+        names = [names] if isinstance(names, str) else list(names)
+        keep = np.array([lc.name not in names for lc in self.lcs], dtype=bool)
+        self.lcs = [lc for lc, k in zip(self.lcs, keep) if k]
+        if 'table' not in self.__dict__:
+            return self
+        new_index = np.cumsum(keep) - 1
+        mom_lc = self.table['mom_lc'].to_numpy(dtype=int)
+        table = self.table[keep[mom_lc]].copy()
+        table['mom_lc'] = new_index[mom_lc[keep[mom_lc]]]
+        self.set_table(table)
+        return self
 
-        # Patrick: lieber erst implementieren, wenns gebraucht wird bzw mit property decorator siehe unten
-        self.mom_lc = np.array(mom_lc)[mask]
-        self.hopjects = np.array(hopjects, dtype = object)[mask]
-        self.dur = np.array([h.dur for h in hopjects])[mask]
-        self.rise_time = np.array([h.rise_time for h in hopjects])[mask]
-        self.decay_time = np.array([h.decay_time for h in hopjects])[mask]
-        self.asym = np.array([h.asym for h in hopjects])[mask]
-        self.start_flux = np.array([h.start_flux for h in hopjects])[mask]
-        self.peak_flux = np.array([h.peak_flux for h in hopjects])[mask]
-        self.end_flux = np.array([h.end_flux for h in hopjects])[mask]
-        self.rise_flux = np.array([h.rise_flux for h in hopjects])[mask]
-        self.decay_flux = np.array([h.decay_flux for h in hopjects])[mask]
-        self.z = np.array([h.z for h in hopjects])[mask]
-
-        ## these attributes only exist if HOP.get_exp_flare was run before
-        #self.exp_tr = np.array([h.exp_tr for h in hopjects if not h.exp_tr is None])[mask]
-        #self.exp_td = np.array([h.exp_td for h in hopjects])[mask]
-        #self.exp_amp = np.array([h.exp_amp for h in hopjects])[mask]
-        #self.exp_t0 = np.array([h.exp_t0 for h in hopjects])[mask]
-        #self.exp_chisqr = np.array([h.exp_chisqr for h in hopjects])[mask]
-        #self.exp_redchi = np.array([h.exp_redchi for h in hopjects])[mask]
-
-    @property
-    def exp_tr(self):
-        return np.array([h.exp_tr for h in hopjects])[mask]
+    def merge(self, other):
+        """
+        Add the light curves and hops of another LC_Set with the same settings (e.g. a part of
+        a population processed on another machine); nothing is searched or fitted again
+        unless only one of both has an exponential fit. Returns self
+        """
+        for key in ['hop_method', 'lc_edges', 'baseline', 'block_min', 'gamma_value', 'p0_value']:
+            if np.any(getattr(self, key) != getattr(other, key)):
+                raise ValueError('cannot merge LC_Sets with different ' + key)
+        first = len(self.lcs)
+        if 'table' not in self.__dict__ and 'table' not in other.__dict__:
+            self.lcs = list(self.lcs) + list(other.lcs)
+            return self # both lazy, nothing searched yet
+        # tables of both sets before self.lcs is extended (self.table of a lazy set would
+        # otherwise be searched in the light curves of other as well)
+        if 'exp_fitted' in self.table or 'exp_fitted' in other.table:
+            self.exp_table, other.exp_table
+        self.lcs = list(self.lcs) + list(other.lcs)
+        table = other.table.copy()
+        table['mom_lc'] = table['mom_lc'].to_numpy(dtype=int) + first
+        self.set_table(concat_tables([self.table, table]))
+        return self
+
+    mom_lc = table_column('mom_lc')
+    n_blocks = table_column('n_blocks')
+    dur = table_column('dur')
+    rise_time = table_column('rise_time')
+    decay_time = table_column('decay_time')
+    asym = table_column('asym')
+    start_flux = table_column('start_flux')
+    peak_flux = table_column('peak_flux')
+    end_flux = table_column('end_flux')
+    rise_flux = table_column('rise_flux')
+    decay_flux = table_column('decay_flux')
+    z = table_column('z')
+    # fit-free shape, see HOP.estimate_shape
+    est_amp = table_column('est_amp')
+    est_t0 = table_column('est_t0')
+    est_tr = table_column('est_tr')
+    est_td = table_column('est_td')
+    slope_tr = table_column('slope_tr')
+    slope_td = table_column('slope_td')
+    est_ok = table_column('est_ok')
+    # exponential fit (NaN if not fitted), see HOP.fit_exp_batch
+    exp_tr = table_column('exp_tr', 'exp_table')
+    exp_td = table_column('exp_td', 'exp_table')
+    exp_amp = table_column('exp_amp', 'exp_table')
+    exp_t0 = table_column('exp_t0', 'exp_table')
+    exp_chisqr = table_column('exp_chisqr', 'exp_table')
+    exp_redchi = table_column('exp_redchi', 'exp_table')
+    exp_converged = table_column('exp_converged', 'exp_table')
+
+    @cached_property
+    def dur_intr(self):
+        # intrinsic (redshift corrected) duration, see zcor
+        return self.zcor(self.dur)
+
+    @cached_property
+    def rise_time_intr(self):
+        return self.zcor(self.rise_time)
+
+    @cached_property
+    def decay_time_intr(self):
+        return self.zcor(self.decay_time)
+
+    #----------------------------------------------------------------------------------------------
+    def add_lc_column(self, key, values):
+        """
+        One value per light curve (e.g. source class) as column key of the flare table
+        """
+        self.table[key] = np.asarray(values)[self.mom_lc.astype(int)]
+        self._subsets.pop(key, None)
+
+    def subsets(self, key):
+        """
+        Flare table split by the values of column key (memoized), e.g.
+            lc_set.add_lc_column('class', classes); lc_set.subsets('class')['FSRQ'].dur
+        Returns dict value -> pd.DataFrame (rows of the flare table)
+        """
+        if key not in self._subsets:
+            self._subsets[key] = {value: rows for value, rows in self.table.groupby(key)}
+        return self._subsets[key]
     
     #----------------------------------------------------------------------------------------------
     def zcor(self, times): #times = e.g. LC_Set.dur
@@ -142,3 +492,34 @@ class LC_Set:
             histo, fancy_bins, p = fancy_hist(self.dur, bins='knuth', density=dens, edgecolor='k',
                                               color='limegreen')
 
+
+
+if __name__ == '__main__':
+    # check: merging lazy and/or eager LC_Sets gives the same flare table as one LC_Set
+    # Run with: python LC_Set.py
+    from bench_bblocks import simulate_lc
+    lcs = []
+    for seed in range(12):
+        lc = LightCurve(*simulate_lc(300, seed=seed))
+        lc.get_bblocks(engine='native')
+        lcs.append(lc)
+    reference = LC_Set(lcs, exp_fit=None).table
+    for lazy_a, lazy_b in [(True, False), (False, True), (True, True), (False, False)]:
+        merged = LC_Set(lcs[:6], exp_fit=None, lazy=lazy_a).merge(
+                 LC_Set(lcs[6:], exp_fit=None, lazy=lazy_b)).table
+        pd.testing.assert_frame_equal(merged, reference)
+        print('merge lazy =', (lazy_a, lazy_b), ':', len(merged), 'flares, ok')
+    # check: lc.hops is set as with lc.find_hop, also with worker processes
+    for n_workers in [None, 2]:
+        for lc in lcs:
+            lc.hops = None
+        LC_Set(lcs, exp_fit=None, n_workers=n_workers, chunk_size=4)
+        for lc in lcs:
+            hops = lc.hops
+            found = lc.find_hop('flip')
+            assert (hops is None) == (found is None)
+            if found is not None:
+                assert [(h.start_time, h.end_time) for h in hops] == \
+                       [(h.start_time, h.end_time) for h in found]
+        print('lc.hops n_workers =', n_workers, ':', sum(len(lc.hops or []) for lc in lcs),
+              'hops, ok')
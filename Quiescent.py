@@ -1,78 +1,158 @@
 
 import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import HopFinder
 import HOP
 import LC
 import LC_Set
 import matplotlib.pyplot as plt
 
-def quiescent_background_finder(sourcelightcurve,method='forward'):
-    # Determines the "quiescent background" of a given lightcurve
-    # Takes the average of all flux values not within HOP objects.
-    # !!!!! MUST USE get_bblocks AND find_hop METHODS BEFORE RUNNING THIS FUNCTION !!!!!!
-    qui = sourcelightcurve
-    mask = []
-    j=0
-    start = 0
-    end = 0
-    if sourcelightcurve.hops == None:
-        quiescent_background = np.nanmean(qui.flux)
-        qui_err = np.sum((np.array(qui.flux_error)**2)*(1/(len(np.array(qui.flux_error))))**2)**0.5
-        print('no flares detected, quiescent background is all bins')
-        return quiescent_background,qui_err
-
-    if method == 'forward':
-        #forward. Compares time current time bin and next time bin when finding tmid.
-        for j in range(0,len(sourcelightcurve.hops)):
-
-            for i in range(0,len(sourcelightcurve.time)-1):
-                tmid = (sourcelightcurve.time[i]+sourcelightcurve.time[i+1])/2
-                if tmid == sourcelightcurve.hops[j].start_time:
-                    start = i
-                if tmid == sourcelightcurve.hops[j].end_time:
-                    end = i
-            if end < start:
-                break
-            #print(start,end)
-            mask.append((start,end))
-        maskindices = np.concatenate([np.arange(start,end) for start,end in mask])
-        qui.flux = np.delete(qui.flux,maskindices)
-        qui.time = np.delete(qui.time,maskindices)
-        
-        baseaverage = []
-        weights = []
-        tempavg = []
-        
-        for i in range(0,len(qui.flux)-1):
-
-            if (qui.time[i+1]-qui.time[i]!= 604800 or i==len(qui.flux)):
-                if np.isnan(np.mean(tempavg)):
-                    pass
-                else:
-                    baseaverage.append(np.mean(tempavg))
-                    weights.append(len(tempavg))
-                    tempavg =[]
-            else:
-                tempavg.append(qui.flux[i])
-
-        #print(baseaverage,weights)
-        qui.flux_error = np.delete(qui.flux_error,maskindices)
-
-
-        quiescent_background = np.nanmean(np.average(baseaverage,weights = weights))
-        qui_err = np.sum((np.array(qui.flux_error)**2)*(1/(len(np.array(qui.flux_error))))**2)**0.5
-        print(quiescent_background,qui_err)
-
-    if qui_err == None:
-        qui_err = 0
-
-    return quiescent_background, qui_err
+import logging
+logging.basicConfig(level=logging.ERROR) #see LC.py
+
+# bin width of the LCR cadences in days (the LCR 'daily' cadence has 3-day bins)
+CADENCE_DAYS = {'daily': 3, 'weekly': 7, 'monthly': 30}
+
+def hop_edges(hops):
+    # start_time, end_time arrays of hops (list of Hopjects, flare table or None)
+    if hops is None or len(hops) == 0:
+        return np.zeros(0), np.zeros(0)
+    if hasattr(hops, 'columns'):
+        return hops['start_time'].to_numpy(dtype=float), hops['end_time'].to_numpy(dtype=float)
+    return (np.array([hop.start_time for hop in hops], dtype=float),
+            np.array([hop.end_time for hop in hops], dtype=float))
+
+def flare_mask(time, starts, ends):
+    """
+    Boolean mask of bins within any hop (start_time < time < end_time, like Hopject.iis)
+    Each hop adds +1 at its first and -1 behind its last bin, the cumulative sum counts the hops
+    covering a bin (overlapping hops are fine)
+    """
+    bin_start = np.searchsorted(time, starts, side='right')
+    bin_end = np.maximum(np.searchsorted(time, ends, side='left'), bin_start)
+    n = len(time)
+    step = np.bincount(bin_start, minlength=n+1)[:n+1] - np.bincount(bin_end, minlength=n+1)[:n+1]
+    return np.cumsum(step)[:n] > 0
+
+def quiescent_background(time, flux, flux_error, starts, ends, cadence=None):
+    """
+    Quiescent background of arrays: mean flux of the bins outside all hops (starts, ends)
+    Bins are grouped into contiguous segments (time step not larger than 1.5 cadence, default:
+    median time step); background = mean of segment means weighted by number of valid bins
+    Returns quiescent_background, qui_err, mask (True: quiescent bin)
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    flux_error = np.asarray(flux_error, dtype=float)
+    quiet = ~flare_mask(time, starts, ends)
+    if not np.any(quiet):
+        logging.info('all time bins are flaring, no quiescent background')
+        return np.nan, np.nan, quiet
+    t, f, e = time[quiet], flux[quiet], flux_error[quiet]
+    if cadence is None:
+        cadence = np.median(np.diff(time)) if len(time) > 1 else 1.
+    # segments of contiguous quiescent bins; reduceat sums each segment
+    seg_start = np.concatenate([[0], np.flatnonzero(np.diff(t) > 1.5 * cadence) + 1])
+    valid = np.isfinite(f)
+    counts = np.add.reduceat(valid.astype(int), seg_start)
+    sums = np.add.reduceat(np.where(valid, f, 0.), seg_start)
+    ok = counts > 0
+    if np.any(ok):
+        background = np.average(sums[ok] / counts[ok], weights=counts[ok])
+    else:
+        background = np.nan
+    qui_err = np.sqrt(np.sum(e**2)) / len(e)
+    return background, qui_err, quiet
+
+def quiescent_background_finder(sourcelightcurve, method='forward', hops=None, cadence=None):
+    """
+    Determines the "quiescent background" of a given lightcurve:
+    weighted average of the flux in contiguous segments that are not within HOP objects
+    hops: default sourcelightcurve.hops (Hopjects or flare table), i.e. use get_bblocks and
+    find_hop before; cadence: time step of the light curve in units of lc.time, default from
+    lc.cadence ('daily', 'weekly', 'monthly' for time in days) or median time step
+    The light curve is not changed. Returns quiescent_background, qui_err
+    """
+    # method: only 'forward' (kept for old calls)
+    lc = sourcelightcurve
+    if hops is None:
+        hops = getattr(lc, 'hops', None)
+    starts, ends = hop_edges(hops)
+    if len(starts) == 0:
+        logging.info('no flares detected, quiescent background is all bins')
+    if cadence is None and getattr(lc, 'time_format', None) == 'mjd':
+        cadence = CADENCE_DAYS.get(getattr(lc, 'cadence', None))
+    background, qui_err, _ = quiescent_background(lc.time, lc.flux, lc.flux_error,
+                                                  starts, ends, cadence)
+    return background, qui_err
+
+def quiescent_fixed_point(sourcelightcurve, percent=0.1, lc_edges='add', rtol=1e-6,
+                          max_iter=50):
+    """
+    Quiescent background as fixed point of baseline -> baseline HOPs -> quiescent background
+    Starts at baseline = min + percent * (max - min) of the flux. The Bayesian blocks do not
+    depend on the baseline: run lc.get_bblocks() once before, each iteration only compares
+    block_val with the baseline and looks up the hop bins in prefix sums of the flux, i.e.
+    O(blocks + hops log N). Stops when the background changes by less than rtol (relative),
+    e.g. exactly 0 when the hops are the same as in the previous iteration.
+    lc.baseline is set to the result (call lc.find_hop('baseline', lc_edges, baseline) for hops)
+    Returns quiescent_background, qui_err, n_iter, converged
+    """
+    lc = sourcelightcurve
+    finder = HopFinder.HopFinderBaseline(lc_edges)
+    valid = np.isfinite(lc.flux)
+    # prefix sums: sum over bins [a, b) is cs[b] - cs[a]
+    cs_flux = np.concatenate([[0.], np.cumsum(np.where(valid, lc.flux, 0.))])
+    cs_valid = np.concatenate([[0], np.cumsum(valid)])
+    cs_err2 = np.concatenate([[0.], np.cumsum(lc.flux_error**2)])
+    n = len(lc.time)
+
+    def background(starts, ends):
+        # union of hop bins (start_time < time < end_time), hops sorted by start
+        bin_start = np.searchsorted(lc.time, starts, side='right')
+        bin_end = np.maximum(np.searchsorted(lc.time, ends, side='left'), bin_start)
+        order = np.argsort(bin_start, kind='stable')
+        bin_start, bin_end = bin_start[order], bin_end[order]
+        covered = np.maximum.accumulate(np.concatenate([[0], bin_end]))[:-1]
+        bin_start = np.minimum(np.maximum(bin_start, covered), bin_end)
+        n_quiet = n - np.sum(bin_end - bin_start)
+        n_valid = cs_valid[-1] - np.sum(cs_valid[bin_end] - cs_valid[bin_start])
+        if n_quiet == 0 or n_valid == 0:
+            return np.nan, np.nan
+        flux = cs_flux[-1] - np.sum(cs_flux[bin_end] - cs_flux[bin_start])
+        err2 = cs_err2[-1] - np.sum(cs_err2[bin_end] - cs_err2[bin_start])
+        return flux / n_valid, np.sqrt(err2) / n_quiet
+
+    minflux, maxflux = np.nanmin(lc.flux), np.nanmax(lc.flux)
+    baseline = minflux + percent * (maxflux - minflux)
+    qui_err = np.nan
+    converged = False
+    for n_iter in range(1, max_iter + 1):
+        lc.baseline = baseline
+        starts, ends = finder.find_start_end(lc)
+        peaks, starts, ends = finder.clean(finder.find_peaks(lc), starts, ends, lc)
+        if peaks is None:
+            starts, ends = np.zeros(0), np.zeros(0)
+        new, qui_err = background(starts, ends)
+        if np.isnan(new):
+            logging.info('all time bins are flaring, no quiescent background')
+            baseline = new
+            break
+        change = abs(new - baseline)
+        baseline = new
+        if change <= rtol * abs(new):
+            converged = True
+            break
+    lc.baseline = baseline
+    return baseline, qui_err, n_iter, converged
 
 def LCTimeRange(sourcearray, timerangestart,timerangeend):
     sourcearray = sourcearray[timerangestart:timerangeend]
     return sourcearray
 
-def quiescent_flare_plot(cadence_df,sourcename=None,sourcenum=0,percent = 0.1, MJDREFI=51910, MJDREFF=7.428703703703703e-4,bkg_err = False,factor = 1):
+def quiescent_flare_plot(cadence_df,sourcename=None,sourcenum=0,percent = 0.1, MJDREFI=51910, MJDREFF=7.428703703703703e-4,bkg_err = False,factor = 1,max_iter=50):
     # Depending on what we are doing analysis on/how our time is binned, we can change the MJDREFI to other values.
     
     SecsInDay = 86400
@@ -90,36 +170,16 @@ def quiescent_flare_plot(cadence_df,sourcename=None,sourcenum=0,percent = 0.1, M
     errors = sourcearray['photon_flux_error2']
 
     sourcelightcurve = LC.LightCurve(time,photon_flux,errors,time_format='mjd')
-    maxflux = np.max(photon_flux)
-    minflux =np.min(photon_flux)
-    delta_flux = maxflux - minflux
-    delta_flux_percent = delta_flux * percent
-    thresholdflux = minflux + delta_flux_percent
-
-
-    # Finding first set of flares using threshold flux.
-    sourcelightcurve.get_bblocks(gamma_value=0.05)
-    sourcelightcurve.find_hop(method = 'baseline', lc_edges ='add', baseline = thresholdflux)
-
-    #if sourcelightcurve.hops == None:
-    #    print("No flares detected for "+str(titlestring))
-    #    return None
-
-
-    # Finding quiescent background.
-    quiescent_background, qui_err = quiescent_background_finder(sourcelightcurve,'forward')
+    # Bayesian blocks once; quiescent background as fixed point of baseline -> hops -> background
+    # starting at min + percent * (max - min) (max_iter=1: one refinement, like before)
+    sourcelightcurve.get_bblocks(gamma_value=0.05, cache=True)
+    quiescent_background, qui_err, n_iter, converged = \
+        quiescent_fixed_point(sourcelightcurve, percent=percent, lc_edges='add', max_iter=max_iter)
+    logging.info(f'quiescent background after {n_iter} iterations, converged: {converged}')
 
-
-    # Using quiescent background to find flares again.
-    sourcelightcurve = LC.LightCurve(time,photon_flux,errors,time_format='mjd')
-
-
-    #sourcelightcurve.flux = np.subtract(sourcelightcurve.flux,quiescent_background)
-    sourcelightcurve.get_bblocks(gamma_value=0.05)
-    #sourcelightcurve.get_bblocks_above(threshold = 0)
+    # Flares above the quiescent background (same blocks).
     sourcelightcurve.find_hop(method = 'baseline', lc_edges ='add',baseline = quiescent_background)
 
-    
     # Plotting the Lightcurve itself.
     plt.figure(figsize=(16,9))
     plt.xlabel("Time (s)")
@@ -134,4 +194,115 @@ def quiescent_flare_plot(cadence_df,sourcename=None,sourcenum=0,percent = 0.1, M
         plt.fill_between(range(len(sourcelightcurve.time)),y1,y2,alpha = 0.3)
 
     sourcelightcurve.plot_hop()
-    plt.legend()
\ No newline at end of file
+    plt.legend()
+
+
+#----------------------------------------------------------------------------------------------
+# Population pipeline: quiescent background and baseline HOPs of all sources of the LCR table
+SOURCE_COLUMNS = ['source_name', 'cadence', 'n_bins', 'time_start', 'time_stop', 'mean_flux',
+                  'n_blocks', 'quiescent_background', 'qui_err', 'n_iter', 'converged',
+                  'n_flares', 'error']
+
+def split_sources(cadence_df, factor=1, MJDREFI=51910, outlier_factor=100, names=None):
+    """
+    Filter the LCR cadence table (all sources) at once and split it by source (one groupby):
+    drop bins with photon_flux2 == -3333 and (outlier_factor not None) bins above
+    outlier_factor * mean flux of the source, like quiescent_flare_plot
+    Returns list of (source_name, cadence, time [MJD], flux * factor, flux_error)
+    """
+    df = cadence_df
+    if names is not None:
+        df = df[df['source_name'].isin(names)]
+    df = df[df['photon_flux2'].to_numpy() != -3333]
+    if outlier_factor is not None:
+        mean = df.groupby('source_name', sort=False)['photon_flux2'].transform('mean')
+        df = df[df['photon_flux2'].to_numpy() <= outlier_factor * mean.to_numpy()]
+    has_cadence = 'cadence' in df
+    sources = []
+    for name, ii in df.groupby('source_name', sort=False).indices.items():
+        rows = df.iloc[ii]
+        sources.append((name, rows['cadence'].iloc[0] if has_cadence else None,
+                        rows['tmin'].to_numpy(dtype=float) / 86400 + MJDREFI,
+                        rows['photon_flux2'].to_numpy(dtype=float) * factor,
+                        rows['photon_flux_error2'].to_numpy(dtype=float)))
+    return sources
+
+def quiescent_flares_chunk(sources, percent=0.1, gamma_value=0.05, p0_value=0.05,
+                           engine='astropy', cache=None, max_iter=50):
+    """
+    Bayesian blocks, quiescent background (quiescent_fixed_point) and baseline HOPs (lc_edges
+    'add', baseline = quiescent background) of sources (see split_sources)
+    Returns source table (SOURCE_COLUMNS) and flare table (HopFinder.hop_table + source_name)
+    A source that fails (e.g. too few bins) gets its error message and no flares.
+    """
+    rows = []
+    tables = []
+    for name, cadence, time, flux, flux_error in sources:
+        row = dict.fromkeys(SOURCE_COLUMNS, np.nan)
+        row.update(source_name=name, cadence=cadence, n_bins=len(time), n_flares=0, error='',
+                   converged=False, n_iter=0)
+        try:
+            lc = LC.LightCurve(time, flux, flux_error, time_format='mjd', name=name,
+                               cadence=cadence)
+            row.update(time_start=time[0], time_stop=time[-1], mean_flux=np.mean(flux))
+            lc.get_bblocks(gamma_value=gamma_value, p0_value=p0_value, engine=engine,
+                           cache=cache)
+            background, qui_err, n_iter, converged = \
+                quiescent_fixed_point(lc, percent=percent, lc_edges='add', max_iter=max_iter)
+            row.update(n_blocks=len(lc.block_val), quiescent_background=background,
+                       qui_err=qui_err, n_iter=n_iter, converged=converged)
+            if not np.isnan(background):
+                table = lc.find_hop(method='baseline', lc_edges='add', baseline=background,
+                                    table=True)
+                row['n_flares'] = len(table)
+                if len(table) > 0:
+                    table.insert(0, 'source_name', name)
+                    table['quiescent_background'] = background
+                    tables.append(table)
+        except Exception as e:
+            logging.warning(str(name) + ': ' + repr(e))
+            row['error'] = repr(e)
+        rows.append(row)
+    flares = pd.concat(tables, ignore_index=True) if len(tables) > 0 else None
+    return pd.DataFrame(rows, columns=SOURCE_COLUMNS), flares
+
+def quiescent_flare_population(cadence_df, names=None, percent=0.1, factor=1, MJDREFI=51910,
+                               outlier_factor=100, gamma_value=0.05, p0_value=0.05,
+                               engine='astropy', cache=None, max_iter=50, n_workers=None,
+                               chunk_size=16, return_sources=False):
+    """
+    Non-plotting batch version of quiescent_flare_plot for all sources (or names) of the LCR
+    cadence table: the table is filtered and split by source once (split_sources), sources are
+    processed in chunks of chunk_size, in this process (n_workers None or 1) or in n_workers
+    worker processes (see quiescent_flares_chunk; results do not depend on n_workers)
+    cache: e.g. bblocks_cache.BBlocksCache(path=...) to share Bayesian blocks between runs
+    return_sources: also return the split light curves (see split_sources), e.g. for
+                    mdp_cube.fluence_population, so the table is not split a second time
+    Returns
+        sources: pd.DataFrame, one row per source (SOURCE_COLUMNS)
+        flares: pd.DataFrame, one row per flare (HopFinder.HOP_COLUMNS with source_name and
+                quiescent_background), e.g. for fluence and MDP of the COSI notebooks
+        sources (return_sources): list of (source_name, cadence, time, flux, flux_error)
+    """
+    sources = split_sources(cadence_df, factor, MJDREFI, outlier_factor, names)
+    chunks = [sources[i:i+chunk_size] for i in range(0, len(sources), chunk_size)]
+    find = partial(quiescent_flares_chunk, percent=percent, gamma_value=gamma_value,
+                   p0_value=p0_value, engine=engine, cache=cache, max_iter=max_iter)
+    if n_workers is None or n_workers <= 1:
+        results = [find(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(find, chunks))
+    if len(results) > 0:
+        source_table = pd.concat([s for s, _ in results], ignore_index=True)
+    else:
+        source_table = pd.DataFrame(columns=SOURCE_COLUMNS)
+    flares = [f for _, f in results if f is not None]
+    if len(flares) > 0:
+        flare_table = pd.concat(flares, ignore_index=True)
+    else:
+        flare_table = pd.DataFrame(columns=['source_name'] + HopFinder.HOP_COLUMNS
+                                   + ['quiescent_background'])
+    if return_sources:
+        return source_table, flare_table, sources
+    return source_table, flare_table
@@ -0,0 +1,115 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+import logging
+logging.basicConfig(level=logging.ERROR) #see LC.py
+
+"""
+Cache of Bayesian block results
+--------------------------------------------------------------------------
+The edges of the Bayesian blocks only depend on the data (time, flux, flux_error) and on the
+prior (gamma_value, p0_value). They are cached with a content hash of both as key, so repeated
+analyses of the same data (e.g. the same LCR snapshot in every notebook session) skip the
+O(N^2) dynamic program. Block parameters are recomputed from the edges (cheap, see block_stats).
+
+Results are kept in memory (least recently used are evicted beyond maxsize) and, if path is
+given, saved on disk as one .npy file per key.
+For example:
+    lc.get_bblocks(gamma_value=0.05, cache=True)            # default_cache (memory only)
+    bblocks_cache.default_cache = BBlocksCache(path='bblocks_cache') # persistent
+    lc.get_bblocks(gamma_value=0.05, cache=BBlocksCache(path='my_cache'))
+"""
+
+
+def bblocks_key(time, flux, flux_error, gamma_value=None, p0_value=0.05):
+    """
+    Content hash of light curve data and prior of the Bayesian blocks
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for a in (time, flux, flux_error):
+        a = np.ascontiguousarray(a, dtype=float)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    h.update(repr((None if gamma_value is None else float(gamma_value),
+                   None if p0_value is None else float(p0_value))).encode())
+    return h.hexdigest()
+
+
+class BBlocksCache:
+    '''
+    Bayesian Blocks Cache
+    =====================
+    key -> edges of the Bayesian blocks (see bblocks_key())
+    maxsize: number of results kept in memory (least recently used are evicted)
+    path: directory for persistent results (None: memory only)
+    '''
+    def __init__(self, maxsize=1024, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __repr__(self):
+        return f'BBlocksCache (in memory = {len(self.memory)}, maxsize = {self.maxsize}, ' + \
+               f'path = {self.path}, hits = {self.hits}, misses = {self.misses})'
+
+    def __len__(self):
+        return len(self.memory)
+
+    def file(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key):
+        """
+        Returns (a copy of) the cached edges or None
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key].copy()
+        if self.path is not None and os.path.exists(self.file(key)):
+            edges = np.load(self.file(key))
+            self.store_memory(key, edges)
+            self.hits += 1
+            return edges.copy()
+        self.misses += 1
+        return None
+
+    def put(self, key, edges):
+        edges = np.array(edges, dtype=float)
+        self.store_memory(key, edges)
+        if self.path is not None:
+            # write to temporary file first so that parallel sessions never read half a file
+            tmp = self.file(key) + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, edges)
+            os.replace(tmp, self.file(key))
+
+    def store_memory(self, key, edges):
+        self.memory[key] = edges
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def clear(self, disk=False):
+        self.memory.clear()
+        if disk and self.path is not None:
+            for f in os.listdir(self.path):
+                if f.endswith('.npy'):
+                    os.remove(os.path.join(self.path, f))
+
+
+default_cache = BBlocksCache()
+
+def get_cache(cache):
+    # cache=True -> default_cache, cache=BBlocksCache -> that one, None/False -> no cache
+    if cache is True:
+        return default_cache
+    if cache is None or cache is False:
+        return None
+    return cache
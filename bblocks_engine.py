@@ -0,0 +1,251 @@
+import numpy as np
+import bblocks_cache
+
+import logging
+logging.basicConfig(level=logging.ERROR) #see LC.py
+
+"""
+Batched Bayesian blocks engine for point measures (fitness='measures')
+--------------------------------------------------------------------------
+Same dynamic program as astropy.stats.bayesian_blocks (Scargle et al. 2013,
+https://ui.adsabs.harvard.edu/abs/2013arXiv1304.2818S/abstract) but for a whole batch of
+light curves at once, without astropy's input validation and per-step Python overhead.
+
+A batch is 'ragged': all light curves are concatenated into one time, flux, flux_error array
+and offsets give the position of each light curve, i.e. light curve i is [offsets[i]:offsets[i+1]]
+For example:
+    time, flux, flux_error, offsets = concat_lcs(lcs)
+    edges, edge_offsets = bblocks_measures(time, flux, flux_error, offsets)
+
+The fitness of each cell is computed from the same reversed cumulative sums (of 1/sigma^2 and
+flux/sigma^2) and in the same order of operations as astropy -> identical change points.
+Time has to be sorted and unique within each light curve (as for LightCurve).
+"""
+
+
+def concat_lcs(lcs):
+    """
+    Concatenate time, flux, flux_error of a list of LightCurves into one ragged batch
+    """
+    n_bins = np.array([len(lc.time) for lc in lcs])
+    offsets = np.concatenate([[0], np.cumsum(n_bins)])
+    time = np.concatenate([lc.time for lc in lcs]).astype(float)
+    flux = np.concatenate([lc.flux for lc in lcs]).astype(float)
+    flux_error = np.concatenate([lc.flux_error for lc in lcs]).astype(float)
+    return(time, flux, flux_error, offsets)
+
+def ncp_prior(n_bins, p0_value=0.05, gamma_value=None):
+    """
+    Prior on the number of change points (see astropy FitnessFunc.compute_ncp_prior)
+    gamma overrides p0; p0 is the false alarm probability (empirical relation, Scargle et al. 2013)
+    """
+    n_bins = np.asarray(n_bins)
+    if gamma_value is not None:
+        return np.full(n_bins.shape, -np.log(gamma_value))
+    elif p0_value is not None:
+        return 4 - np.log(73.53 * p0_value * (n_bins**-0.478))
+    else:
+        raise ValueError('ncp_prior cannot be computed as neither gamma nor p0 is defined.')
+
+def segment_sum(values, starts, lengths):
+    """
+    Sum of values[starts[j]:starts[j]+lengths[j]] for all segments j without a loop over segments
+    Segments of equal length are summed as rows of one 2D array (one call per distinct length),
+    which uses the same pairwise summation as np.sum -> bit-identical to summing each slice
+    (np.add.reduceat sums sequentially and differs in the last digits)
+    """
+    order = np.argsort(lengths, kind='stable')
+    groups = np.split(order, np.flatnonzero(np.diff(lengths[order])) + 1)
+    sums = np.zeros(len(starts))
+    for seg in groups:
+        if len(seg) > 0 and lengths[seg[0]] > 0:
+            sums[seg] = values[starts[seg, None] + np.arange(lengths[seg[0]])].sum(axis=1)
+    return sums
+
+def cell_edges(time):
+    # possible edges: first bin, midpoints between bins, last bin (like astropy)
+    return np.concatenate([time[:1], 0.5 * (time[1:] + time[:-1]), time[-1:]])
+
+def change_points(last):
+    """
+    Backtrack change points from the last-change-point array of the dynamic program
+    Returns index of the first bin of each block (and len(last) as end of the last block),
+    this is the same as edge_index of LightCurve.get_bblocks
+    """
+    cps = [len(last)]
+    ind = last[-1]
+    while ind > 0:
+        cps.append(ind)
+        ind = last[ind - 1]
+    cps.append(0)
+    return np.array(cps[::-1])
+
+def bblocks_dp(time, flux, flux_error, offsets, p0_value=0.05, gamma_value=None):
+    """
+    Dynamic program of the Bayesian blocks for all light curves of a ragged batch
+    Returns change points (see change_points()) for each light curve as array of arrays
+    """
+    offsets = np.asarray(offsets)
+    n_bins = np.diff(offsets)
+    if np.any(n_bins < 1):
+        raise ValueError('empty light curve in batch')
+    first = np.zeros(len(time), dtype=bool)
+    first[offsets[:-1]] = True
+    if np.any(np.diff(time)[~first[1:]] <= 0):
+        raise ValueError('time has to be sorted and unique within each light curve')
+
+    # process light curves from longest to shortest -> active curves in step R are [:n_active]
+    order = np.argsort(-n_bins, kind='stable')
+    n_lcs = len(n_bins)
+    n_max = n_bins[order[0]]
+    ak_raw = np.zeros((n_lcs, n_max))
+    bk_raw = np.zeros((n_lcs, n_max))
+    for row, i in enumerate(order):
+        sl = slice(offsets[i], offsets[i+1])
+        ak_raw[row, :n_bins[i]] = np.ones(n_bins[i]) / flux_error[sl]**2
+        bk_raw[row, :n_bins[i]] = flux[sl] / flux_error[sl]**2
+    prior = ncp_prior(n_bins[order], p0_value, gamma_value)[:, None]
+
+    best = np.zeros((n_lcs, n_max))
+    last = np.zeros((n_lcs, n_max), dtype=int)
+    n_active = n_lcs
+    for R in range(n_max):
+        while n_bins[order[n_active-1]] <= R:
+            n_active -= 1
+        # fitness of all blocks [i:R+1] (same operations as astropy PointMeasures)
+        a_k = 0.5 * np.cumsum(ak_raw[:n_active, R::-1], axis=1)[:, ::-1]
+        b_k = - np.cumsum(bk_raw[:n_active, R::-1], axis=1)[:, ::-1]
+        A_R = (b_k * b_k) / (4 * a_k) - prior[:n_active]
+        A_R[:, 1:] += best[:n_active, :R]
+        i_max = np.argmax(A_R, axis=1)
+        last[:n_active, R] = i_max
+        best[:n_active, R] = A_R[np.arange(n_active), i_max]
+    logging.debug('got dynamic program for ' + str(n_lcs) + ' light curves')
+
+    cps = np.zeros(n_lcs, dtype=object)
+    for row, i in enumerate(order):
+        cps[i] = change_points(last[row, :n_bins[i]])
+    return cps
+
+def bblocks_dp_extend(flux, flux_error, ncp_prior, best=None, last=None):
+    """
+    Dynamic program of the Bayesian blocks for one light curve that can be continued:
+    best (best fitness) and last (last change point) of the first len(best) bins are kept and
+    only the rows of the new bins are computed -> O(N) per new bin instead of O(N^2)
+    Returns best, last for all bins (identical to running the full dynamic program)
+    """
+    n_old = 0 if best is None else len(best)
+    n_bins = len(flux)
+    ak_raw = np.ones(n_bins) / flux_error**2
+    bk_raw = flux / flux_error**2
+    best = np.concatenate([np.zeros(0) if best is None else best, np.zeros(n_bins - n_old)])
+    last = np.concatenate([np.zeros(0, dtype=int) if last is None else last,
+                           np.zeros(n_bins - n_old, dtype=int)])
+    for R in range(n_old, n_bins):
+        # fitness of all blocks [i:R+1] (same operations as astropy PointMeasures)
+        a_k = 0.5 * np.cumsum(ak_raw[R::-1])[::-1]
+        b_k = - np.cumsum(bk_raw[R::-1])[::-1]
+        A_R = (b_k * b_k) / (4 * a_k) - ncp_prior
+        A_R[1:] += best[:R]
+        last[R] = np.argmax(A_R)
+        best[R] = A_R[last[R]]
+    return(best, last)
+
+def bblocks_dp_sweep(flux, flux_error, priors):
+    """
+    Dynamic program of the Bayesian blocks for one light curve and several priors (ncp_prior) in
+    one pass: the fitness of each block is the same for all priors, only the prior changes
+    Returns best, last with one row per prior (identical to a separate run for each prior)
+    """
+    priors = np.asarray(priors, dtype=float)[:, None]
+    n_priors = len(priors)
+    n_bins = len(flux)
+    ak_raw = np.ones(n_bins) / flux_error**2
+    bk_raw = flux / flux_error**2
+    best = np.zeros((n_priors, n_bins))
+    last = np.zeros((n_priors, n_bins), dtype=int)
+    for R in range(n_bins):
+        # fitness of all blocks [i:R+1] (same operations as astropy PointMeasures)
+        a_k = 0.5 * np.cumsum(ak_raw[R::-1])[::-1]
+        b_k = - np.cumsum(bk_raw[R::-1])[::-1]
+        A_R = (b_k * b_k) / (4 * a_k) - priors
+        A_R[:, 1:] += best[:, :R]
+        i_max = np.argmax(A_R, axis=1)
+        last[:, R] = i_max
+        best[:, R] = A_R[np.arange(n_priors), i_max]
+    return(best, last)
+
+def bblocks_measures(time, flux, flux_error, offsets, p0_value=0.05, gamma_value=None):
+    """
+    Bayesian block edges (in units of time) for all light curves of a ragged batch
+    Returns edges of all light curves concatenated and edge_offsets,
+    i.e. edges of light curve i are edges[edge_offsets[i]:edge_offsets[i+1]]
+    """
+    cps = bblocks_dp(time, flux, flux_error, offsets, p0_value, gamma_value)
+    edges = [cell_edges(time[offsets[i]:offsets[i+1]])[cp] for i, cp in enumerate(cps)]
+    edge_offsets = np.concatenate([[0], np.cumsum([len(e) for e in edges])])
+    return(np.concatenate(edges), edge_offsets)
+
+def bblocks_batch(time, flux, flux_error, offsets, p0_value=0.05, gamma_value=None):
+    """
+    Bayesian blocks and block parameters (see LightCurve.get_bblocks) for a ragged batch
+    Returns:
+        block_pbin: same layout as flux (light curve i is [offsets[i]:offsets[i+1]])
+        block_val, block_val_error: blocks of all light curves concatenated
+                                    (light curve i is [edge_offsets[i]-i:edge_offsets[i+1]-i-1])
+        edge_index: per light curve position of edges in its own time array (same layout as edges)
+        edges, edge_offsets: see bblocks_measures()
+    """
+    offsets = np.asarray(offsets)
+    cps = bblocks_dp(time, flux, flux_error, offsets, p0_value, gamma_value)
+    edges = np.concatenate([cell_edges(time[offsets[i]:offsets[i+1]])[cp]
+                            for i, cp in enumerate(cps)])
+    edge_offsets = np.concatenate([[0], np.cumsum([len(cp) for cp in cps])])
+    # change points are the edge_index (first bin with time >= edge, last entry = n_bins)
+    edge_index = np.concatenate(cps)
+    global_index = edge_index + np.repeat(offsets[:-1], np.diff(edge_offsets))
+
+    # blocks: all edges but the last of each light curve start a block
+    is_start = np.ones(len(edges), dtype=bool)
+    is_start[edge_offsets[1:]-1] = False
+    starts = global_index[is_start]
+    n_bins = np.diff(global_index)[is_start[:-1]]
+    block_val = segment_sum(flux, starts, n_bins) / n_bins
+    block_val_error = np.sqrt(segment_sum(flux_error**2, starts, n_bins)) / n_bins
+    block_pbin = np.repeat(block_val, n_bins)
+    return(block_pbin, block_val, block_val_error, edge_index, edges, edge_offsets)
+
+def get_bblocks_batch(lcs, gamma_value=None, p0_value=0.05, cache=None):
+    """
+    Batched alternative to running lc.get_bblocks() for each LightCurve in lcs
+    Sets edges, edge_index, block_val, block_val_error and block_pbin for all lcs in one call
+    cache: see LightCurve.get_bblocks(); only light curves not in the cache are computed
+    """
+    cache = bblocks_cache.get_cache(cache)
+    todo = list(lcs)
+    if cache is not None:
+        keys = [bblocks_cache.bblocks_key(lc.time, lc.flux, lc.flux_error, gamma_value, p0_value)
+                for lc in lcs]
+        todo, todo_keys = [], []
+        for lc, key in zip(lcs, keys):
+            edges = cache.get(key)
+            if edges is None:
+                todo.append(lc)
+                todo_keys.append(key)
+            else:
+                lc.set_bblocks(edges)
+                lc.gamma_value, lc.p0_value = gamma_value, p0_value
+        if len(todo) == 0:
+            return lcs
+    time, flux, flux_error, offsets = concat_lcs(todo)
+    block_pbin, block_val, block_val_error, edge_index, edges, edge_offsets = \
+        bblocks_batch(time, flux, flux_error, offsets, p0_value=p0_value, gamma_value=gamma_value)
+    for i, lc in enumerate(todo):
+        es = slice(edge_offsets[i], edge_offsets[i+1])
+        bs = slice(edge_offsets[i] - i, edge_offsets[i+1] - i - 1)
+        lc.set_bblocks(edges[es], (block_pbin[offsets[i]:offsets[i+1]], block_val[bs],
+                                   block_val_error[bs], edge_index[es]))
+        lc.gamma_value, lc.p0_value = gamma_value, p0_value
+        if cache is not None:
+            cache.put(todo_keys[i], lc.edges)
+    return lcs
@@ -0,0 +1,72 @@
+import time as timer
+import numpy as np
+import astropy.stats.bayesian_blocks as bblocks
+from LC import block_stats
+from bblocks_engine import bblocks_measures
+
+"""
+Benchmark for the block parameters in LightCurve.get_bblocks()
+Compares the old loop implementation with the array-based block_stats() in LC.py
+on simulated daily LCR-like light curves and checks that the results are bit-identical.
+Compares astropy.stats.bayesian_blocks (one call per light curve) with the batched engine in
+bblocks_engine.py and checks that the edges are identical.
+Run with: python bench_bblocks.py
+"""
+
+def block_stats_loop(time, flux, flux_error, edges):
+    # old implementation of LightCurve.get_bblocks() (for reference only)
+    edge_index = np.array([np.where(time >= edges[i])[0][0] for i,_ in enumerate(edges)])
+    edge_index[-1] += 1
+    block_val = np.zeros(len(edge_index)-1)
+    block_val_error = np.zeros(len(edge_index)-1)
+    for j in range(len(edge_index)-1):
+        block_val[j] = np.mean(flux[edge_index[j]: edge_index[j+1]])
+        block_val_error[j] = (np.sqrt(np.sum(flux_error[edge_index[j]: edge_index[j+1]]**2))
+                              / (edge_index[j+1]-edge_index[j]))
+    block_pbin = np.zeros(len(flux))
+    for k,_ in enumerate(block_val):
+        block_pbin[edge_index[k] : edge_index[k+1]] = block_val[k]
+    return(block_pbin, block_val, block_val_error, edge_index)
+
+def simulate_lc(n_bins=5000, seed=0):
+    # red-noise-ish daily light curve with flares, flux in ph/cm^2/s
+    rng = np.random.default_rng(seed)
+    time = 54683. + np.arange(n_bins) + rng.uniform(-0.1, 0.1, n_bins)
+    flux = 1e-7 * np.exp(np.cumsum(rng.normal(0, 0.05, n_bins)))
+    flux_error = 0.1 * flux * rng.uniform(0.5, 1.5, n_bins)
+    flux = flux + rng.normal(0, flux_error)
+    return(time, flux, flux_error)
+
+def timeit(func, args, repeat):
+    t0 = timer.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    return (timer.perf_counter() - t0) / repeat, result
+
+
+if __name__ == '__main__':
+    for n_bins in [500, 5000, 20000]:
+        time, flux, flux_error = simulate_lc(n_bins)
+        edges = bblocks(t=time, x=flux, sigma=flux_error, fitness='measures', p0=0.05)
+        t_loop, res_loop = timeit(block_stats_loop, (time, flux, flux_error, edges), 5)
+        t_vec, res_vec = timeit(block_stats, (time, flux, flux_error, edges), 50)
+        identical = all(np.array_equal(a, b) for a, b in zip(res_loop, res_vec))
+        print(f'bins = {n_bins}, blocks = {len(edges)-1}: loop {1e3*t_loop:.2f} ms, '
+              f'block_stats {1e3*t_vec:.3f} ms, speedup {t_loop/t_vec:.0f}x, '
+              f'bit-identical: {identical}')
+
+    n_lcs = 50
+    lcs = [simulate_lc(n_bins, seed) for seed, n_bins in
+           enumerate(np.random.default_rng(1).integers(100, 1000, n_lcs))]
+    t0 = timer.perf_counter()
+    edges_astropy = [bblocks(t=t, x=f, sigma=e, fitness='measures', p0=0.05) for t, f, e in lcs]
+    t_astropy = timer.perf_counter() - t0
+    offsets = np.concatenate([[0], np.cumsum([len(t) for t, _, _ in lcs])])
+    time, flux, flux_error = [np.concatenate([lc[k] for lc in lcs]) for k in range(3)]
+    t0 = timer.perf_counter()
+    edges, edge_offsets = bblocks_measures(time, flux, flux_error, offsets, p0_value=0.05)
+    t_native = timer.perf_counter() - t0
+    identical = all(np.array_equal(e, edges[edge_offsets[i]:edge_offsets[i+1]])
+                    for i, e in enumerate(edges_astropy))
+    print(f'{n_lcs} light curves: astropy {t_astropy:.2f} s, bblocks_measures {t_native:.2f} s, '
+          f'speedup {t_astropy/t_native:.0f}x, same edges: {identical}')
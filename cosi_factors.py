@@ -0,0 +1,196 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+import logging
+logging.basicConfig(level=logging.ERROR) #see LC.py
+
+"""
+LAT -> COSI extrapolation factors
+--------------------------------------------------------------------------
+Vectorized version of LAT_COSI_factor_all.ipynb: the LAT spectrum of each source (4FGL
+PowerLaw, LogParabola, PLSuperExpCutoff or BAT-LAT smpl/smpl_inv fit) is extrapolated into the
+COSI band. For all sources and all index shifts (e.g. 0.5 for 'softer +0.5') at once:
+    ph_flux_LAT, ph_flux_COSI       photon flux [ph/cm2/s] in the LAT and COSI band
+    energy_flux_LAT, energy_flux_COSI   energy flux [MeV/cm2/s]
+    Aeff_mean_LAT(cm2), Aeff_mean_COSI(cm2)   spectrum weighted mean effective area
+    ph/s_ratio = COSI count rate / LAT count rate
+    Int_flux_ratio = ph_flux_COSI / ph_flux_LAT
+(same columns as COSICSV/COSI_factors_all_*.csv, see mdp_cube.count_rate_factors)
+Spectra are plain float arrays[shift, source, energy] on a log-spaced energy grid (trapezoid
+in log E, exact enough with ~1000 points instead of 100000 linear ones) and no plots are made.
+For example:
+    spectra = pd.concat([read_4fgl_spectra('gll_psc_v35.fits', names),
+                         read_bat_lat_spectra('BAT_LAT_match_4FGL_info.fits')])
+    factors = cosi_factors(spectra, shifts=[0, 0.5], cache_dir='COSICSV/cache')
+"""
+
+LAT_BAND = (100., 1e5)  # MeV
+COSI_BAND = (0.2, 5.)   # MeV
+SPECTRUM_TYPES = ['PowerLaw', 'LogParabola', 'PLSuperExpCutoff', 'smpl', 'smpl_inv']
+SPECTRA_COLUMNS = ['Name', 'SpectrumType', 'e0', 'norm', 'index', 'curv', 'exp_index',
+                   'index2']
+FACTOR_COLUMNS = ['Name', 'shift', 'ph/s_ratio', 'Aeff_mean_LAT(cm2)', 'Aeff_mean_COSI(cm2)',
+                  'Int_flux_ratio', 'ph_flux_LAT', 'ph_flux_COSI', 'energy_flux_LAT',
+                  'energy_flux_COSI']
+
+
+def read_4fgl_spectra(path='gll_psc_v35.fits', names=None):
+    """
+    Preferred spectral model of 4FGL sources (all or names) as spectra table (SPECTRA_COLUMNS)
+    e0: Pivot_Energy [MeV]; norm: flux density [ph/cm2/s/MeV] at e0
+    index, curv: PL_Index; LP_Index, LP_beta; PLEC_IndexS, PLEC_ExpfactorS (exp_index b)
+    """
+    from astropy.io import fits
+    with fits.open(path) as f:
+        data = f[1].data
+        table = pd.DataFrame({'Name': np.char.strip(data['Source_Name'].astype(str)),
+                              'SpectrumType': np.char.strip(data['SpectrumType'].astype(str))})
+        for key in ['Pivot_Energy', 'PL_Flux_Density', 'PL_Index', 'LP_Flux_Density',
+                    'LP_Index', 'LP_beta', 'PLEC_Flux_Density', 'PLEC_IndexS',
+                    'PLEC_ExpfactorS', 'PLEC_Exp_Index']:
+            table[key] = np.asarray(data[key], dtype=float)
+    if names is not None:
+        table = table[table['Name'].isin(names)]
+    return spectra_from_4fgl(table)
+
+def spectra_from_4fgl(table):
+    # 4FGL columns -> spectra table (parameters of the preferred model)
+    t = table['SpectrumType'].to_numpy()
+    pl, lp = t == 'PowerLaw', t == 'LogParabola'
+    pick = lambda a, b, c: np.where(pl, table[a], np.where(lp, table[b], table[c]))
+    return pd.DataFrame({'Name': table['Name'].to_numpy(), 'SpectrumType': t,
+                         'e0': table['Pivot_Energy'].to_numpy(dtype=float),
+                         'norm': pick('PL_Flux_Density', 'LP_Flux_Density', 'PLEC_Flux_Density'),
+                         'index': pick('PL_Index', 'LP_Index', 'PLEC_IndexS'),
+                         'curv': np.where(lp, table['LP_beta'], table['PLEC_ExpfactorS']),
+                         'exp_index': table['PLEC_Exp_Index'].to_numpy(dtype=float),
+                         'index2': np.nan}, columns=SPECTRA_COLUMNS)
+
+def read_bat_lat_spectra(path='BAT_LAT_match_4FGL_info.fits'):
+    """
+    Joint BAT-LAT fits (smoothly joined power laws) as spectra table (SPECTRA_COLUMNS)
+    smpl:     norm / ((E/e0)^index + (E/e0)^index2)
+    smpl_inv: norm * ((E/e0)^index + (E/e0)^index2)
+    e0: break energy [MeV] (10^log10(e_break) keV)
+    """
+    from astropy.io import fits
+    with fits.open(path) as f:
+        data = f[1].data
+        return pd.DataFrame({'Name': np.char.strip(data['LAT_NAME'].astype(str)),
+                             'SpectrumType': np.char.strip(data['function'].astype(str)),
+                             'e0': 10**np.asarray(data['log10(e_break)'], dtype=float) / 1e3,
+                             'norm': np.asarray(data['norm'], dtype=float),
+                             'index': np.asarray(data['gamma1'], dtype=float),
+                             'curv': np.nan, 'exp_index': np.nan,
+                             'index2': np.asarray(data['gamma2'], dtype=float)},
+                            columns=SPECTRA_COLUMNS)
+
+def dnde(energy, spectra, shifts=(0.,)):
+    """
+    dN/dE [ph/cm2/s/MeV] of all spectra at energy [MeV]: array[shift, source, energy]
+    shift makes the spectrum softer around e0 (index + shift; smpl_inv: index - shift since
+    its indices are the exponents of E, e.g. -1.8)
+    """
+    e = np.asarray(energy, dtype=float)[None, None, :]
+    shift = np.asarray(shifts, dtype=float)[:, None, None]
+    p = {key: spectra[key].to_numpy(dtype=float)[None, :, None]
+         for key in ['e0', 'norm', 'index', 'curv', 'exp_index', 'index2']}
+    t = spectra['SpectrumType'].to_numpy()[None, :, None]
+    unknown = set(np.unique(t)) - set(SPECTRUM_TYPES)
+    if unknown:
+        raise ValueError('unknown SpectrumType ' + str(unknown))
+    x = e / p['e0']
+    lnx = np.log(x)
+    index = p['index'] + shift
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        # all models on the full grid, then select by type (nan of other models is dropped)
+        pl = p['norm'] * np.exp(-index * lnx)
+        lp = p['norm'] * np.exp(-(index + p['curv'] * lnx) * lnx)
+        b, d = p['exp_index'], p['curv']
+        plec = p['norm'] * np.exp((d / b - index) * lnx + d / b**2 * (1 - np.exp(b * lnx)))
+        smpl = p['norm'] / (np.exp(index * lnx) + np.exp((p['index2'] + shift) * lnx))
+        smpl_inv = p['norm'] * (np.exp((p['index'] - shift) * lnx)
+                                + np.exp((p['index2'] - shift) * lnx))
+    return np.select([t == 'PowerLaw', t == 'LogParabola', t == 'PLSuperExpCutoff',
+                      t == 'smpl', t == 'smpl_inv'], [pl, lp, plec, smpl, smpl_inv])
+
+def read_aeff(path, energy_unit=1., area_unit=1.):
+    # effective area table (energy, area) -> energy [MeV], area [cm2]
+    a = np.loadtxt(path)
+    return a[:, 0] * energy_unit, a[:, 1] * area_unit
+
+def log_trapezoid(lo, hi, n):
+    # log-spaced energies and trapezoid weights for int f dE = int f E dlnE
+    energy = np.geomspace(lo, hi, n)
+    dlne = np.log(hi / lo) / (n - 1)
+    weights = np.full(n, dlne) * energy
+    weights[[0, -1]] /= 2
+    return energy, weights
+
+def band_integrals(spectra, shifts, band, aeff, n_energy):
+    # photon flux, energy flux and count rate (per cm2 of aeff) in band: arrays[shift, source]
+    energy, weights = log_trapezoid(band[0], band[1], n_energy)
+    area = np.interp(energy, aeff[0], aeff[1])
+    f = dnde(energy, spectra, shifts)
+    return f @ weights, f @ (weights * energy), f @ (weights * area)
+
+def factors_key(spectra, shifts, n_energy, lat_aeff, cosi_aeff):
+    # content hash of all inputs (cache key)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(pd.util.hash_pandas_object(spectra[SPECTRA_COLUMNS], index=False).to_numpy()
+             .tobytes())
+    for a in [np.asarray(shifts, dtype=float), np.array([n_energy], dtype=float),
+              *lat_aeff, *cosi_aeff]:
+        h.update(np.ascontiguousarray(a, dtype=float).tobytes())
+    return h.hexdigest()
+
+factors_cache = {} # key -> factor table (this session)
+
+def cosi_factors(spectra, shifts=(0.,), n_energy=1024, lat_aeff=None, cosi_aeff=None,
+                 cache_dir=None):
+    """
+    LAT and COSI band fluxes and extrapolation factors of all spectra (spectra table, see
+    read_4fgl_spectra, read_bat_lat_spectra) for all shifts
+    lat_aeff, cosi_aeff: (energy [MeV], area [cm2]), default LAT_aeff.txt and COSI_aeff.txt
+    Results are cached in memory and (cache_dir) as csv, key: hash of all inputs
+    Returns pd.DataFrame (FACTOR_COLUMNS), one row per shift and source
+    """
+    if lat_aeff is None:
+        lat_aeff = read_aeff('LAT_aeff.txt', area_unit=1e4) # m2 -> cm2
+    if cosi_aeff is None:
+        cosi_aeff = read_aeff('COSI_aeff.txt', energy_unit=1e-3) # keV -> MeV
+    spectra = spectra.reset_index(drop=True)
+    key = factors_key(spectra, shifts, n_energy, lat_aeff, cosi_aeff)
+    if key in factors_cache:
+        return factors_cache[key].copy()
+    path = None if cache_dir is None else os.path.join(cache_dir, 'COSI_factors_' + key + '.csv')
+    if path is not None and os.path.exists(path):
+        factors = pd.read_csv(path)
+    else:
+        ph_lat, en_lat, counts_lat = band_integrals(spectra, shifts, LAT_BAND, lat_aeff,
+                                                    n_energy)
+        ph_cosi, en_cosi, counts_cosi = band_integrals(spectra, shifts, COSI_BAND, cosi_aeff,
+                                                       n_energy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns = {'ph/s_ratio': counts_cosi / counts_lat,
+                       'Aeff_mean_LAT(cm2)': counts_lat / ph_lat,
+                       'Aeff_mean_COSI(cm2)': counts_cosi / ph_cosi,
+                       'Int_flux_ratio': ph_cosi / ph_lat,
+                       'ph_flux_LAT': ph_lat, 'ph_flux_COSI': ph_cosi,
+                       'energy_flux_LAT': en_lat, 'energy_flux_COSI': en_cosi}
+        n_shift, n_src = ph_lat.shape
+        factors = pd.DataFrame({'Name': np.tile(spectra['Name'].to_numpy(), n_shift),
+                                'shift': np.repeat(np.asarray(shifts, dtype=float), n_src),
+                                **{k: v.ravel() for k, v in columns.items()}},
+                               columns=FACTOR_COLUMNS)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            factors.to_csv(path, index=False)
+    factors_cache[key] = factors
+    return factors.copy()
+
+def factor_tables(factors):
+    # {shift: factor table} e.g. for mdp_cube.count_rate_factors
+    return {shift: table.reset_index(drop=True) for shift, table in factors.groupby('shift')}
@@ -0,0 +1,173 @@
+import json
+import numpy as np
+from LC import LightCurve
+
+import logging
+logging.basicConfig(level=logging.ERROR) #see LC.py
+
+"""
+Binary light curve store
+--------------------------------------------------------------------------
+Versioned on-disk format for one or many light curves, including Bayesian blocks and metadata.
+Unlike lc.save_npy() (pickle, breaks whenever LC.py changes) and lc.save_csv() (slow text I/O)
+the raw arrays are written as they are and loaded through a memory map, i.e. opening a store
+with thousands of light curves only reads the header; data is read when a light curve is used.
+
+For example:
+    save_lcs('lcr_weekly.lcs', lcs)
+    store = LCStore('lcr_weekly.lcs')
+    lc = store['4FGL J2253.9+1609']     # LightCurve with blocks, arrays are views of the file
+    lcs = store.load()                  # all light curves
+
+File layout (all numbers little endian):
+    MAGIC (8 bytes) | format version (uint32) | header length (uint64) | header (JSON, utf-8) |
+    arrays, each starting at a multiple of ALIGN bytes (offset, dtype, shape given in header)
+All light curves are concatenated (ragged batch like in bblocks_engine.py):
+    light curve i is [offsets[i]:offsets[i+1]] in time, flux, flux_error, block_pbin
+    and [edge_offsets[i]:edge_offsets[i+1]] in edges, edge_index
+    and [block_offsets[i]:block_offsets[i+1]] in block_val, block_val_error
+"""
+
+MAGIC = b'LCSTORE\x00'
+FORMAT_VERSION = 1
+ALIGN = 64
+META_KEYS = ['name', 'z', 'cadence', 'telescope', 'time_format', 'gamma_value', 'p0_value']
+
+
+def to_json(value):
+    # metadata to JSON-compatible python types (e.g. np.float64 -> float)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def save_lcs(path, lcs):
+    """
+    Write light curves (list of LightCurve objects) with their Bayesian blocks (if initialized)
+    and metadata into one binary file, see LCStore to load it
+    """
+    n_bins = np.array([len(lc.time) for lc in lcs], dtype=np.int64)
+    has_blocks = [hasattr(lc, 'edges') for lc in lcs]
+    n_edges = np.array([len(lc.edges) if b else 0 for lc, b in zip(lcs, has_blocks)],
+                       dtype=np.int64)
+    n_blocks = np.where(n_edges > 0, n_edges - 1, 0)
+    arrays = {
+        'offsets': np.concatenate([[0], np.cumsum(n_bins)]).astype(np.int64),
+        'edge_offsets': np.concatenate([[0], np.cumsum(n_edges)]).astype(np.int64),
+        'block_offsets': np.concatenate([[0], np.cumsum(n_blocks)]).astype(np.int64),
+        'time': np.concatenate([lc.time for lc in lcs]).astype('<f8'),
+        'flux': np.concatenate([lc.flux for lc in lcs]).astype('<f8'),
+        'flux_error': np.concatenate([lc.flux_error for lc in lcs]).astype('<f8'),
+        'block_pbin': np.concatenate([lc.block_pbin if b else np.full(len(lc.time), np.nan)
+                                      for lc, b in zip(lcs, has_blocks)]).astype('<f8'),
+        'edges': np.concatenate([lc.edges for lc, b in zip(lcs, has_blocks) if b]
+                                + [np.zeros(0)]).astype('<f8'),
+        'edge_index': np.concatenate([lc.edge_index for lc, b in zip(lcs, has_blocks) if b]
+                                     + [np.zeros(0)]).astype('<i8'),
+        'block_val': np.concatenate([lc.block_val for lc, b in zip(lcs, has_blocks) if b]
+                                    + [np.zeros(0)]).astype('<f8'),
+        'block_val_error': np.concatenate([lc.block_val_error
+                                           for lc, b in zip(lcs, has_blocks) if b]
+                                          + [np.zeros(0)]).astype('<f8'),
+    }
+    if len(arrays['block_val']) != np.sum(n_blocks):
+        raise ValueError('block_val does not match edges (e.g. after get_bblocks_above)')
+    sources = [{key: to_json(getattr(lc, key, None)) for key in META_KEYS} for lc in lcs]
+    for source, b in zip(sources, has_blocks):
+        source['bblocks'] = b
+
+    # header with position of each array in the file; header length is fixed before offsets
+    layout = {key: {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': 0}
+              for key, a in arrays.items()}
+    header = {'version': FORMAT_VERSION, 'arrays': layout, 'sources': sources}
+    header_len = len(json.dumps(header).encode()) + 32 * len(arrays)
+    position = len(MAGIC) + 4 + 8 + header_len
+    for key, a in arrays.items():
+        position = -(-position // ALIGN) * ALIGN
+        layout[key]['offset'] = position
+        position += a.nbytes
+    header_bytes = json.dumps(header).encode().ljust(header_len)
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array(FORMAT_VERSION, dtype='<u4').tobytes())
+        f.write(np.array(header_len, dtype='<u8').tobytes())
+        f.write(header_bytes)
+        for key, a in arrays.items():
+            f.seek(layout[key]['offset'])
+            f.write(a.tobytes())
+    logging.info('saved ' + str(len(lcs)) + ' light curves to ' + str(path))
+
+
+class LCStore:
+    '''
+    Light Curve Store
+    =================
+    Memory-mapped access to light curves saved with save_lcs()
+    Only the header (index of sources and arrays) is read when opening the file.
+    store[name] or store[i] returns a LightCurve whose arrays are views of the memory map
+    (read-only, validated when they were saved) including Bayesian blocks if they were saved
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(str(path) + ' is not a light curve store')
+            version = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+            if version > FORMAT_VERSION:
+                raise ValueError('light curve store version ' + str(version) +
+                                 ' is newer than supported version ' + str(FORMAT_VERSION))
+            header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_len).decode())
+        self.path = path
+        self.version = version
+        self.sources = header['sources']
+        self.names = [s['name'] for s in self.sources]
+        self.index = {}
+        for i, name in enumerate(self.names):
+            self.index.setdefault(name, i) # first light curve with this name
+        raw = np.memmap(path, dtype=np.uint8, mode='r')
+        self.arrays = {}
+        for key, a in header['arrays'].items():
+            dtype = np.dtype(a['dtype'])
+            nbytes = int(np.prod(a['shape'])) * dtype.itemsize
+            self.arrays[key] = \
+                raw[a['offset']:a['offset'] + nbytes].view(dtype).reshape(a['shape'])
+        self.offsets = np.array(self.arrays['offsets'])
+        self.edge_offsets = np.array(self.arrays['edge_offsets'])
+        self.block_offsets = np.array(self.arrays['block_offsets'])
+
+    def __repr__(self):
+        return f'LCStore (path = {self.path}, light curves = {len(self)}, version = {self.version})'
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, key):
+        """
+        store[name] or store[i] -> LightCurve (views of the memory map)
+        """
+        i = self.index[key] if isinstance(key, str) else int(key)
+        source = self.sources[i]
+        a = self.arrays
+        bins = slice(self.offsets[i], self.offsets[i+1])
+        lc = LightCurve(a['time'][bins], a['flux'][bins], a['flux_error'][bins],
+                        time_format=source['time_format'], name=source['name'], z=source['z'],
+                        telescope=source['telescope'], cadence=source['cadence'],
+                        validate=False, copy=False)
+        if source['bblocks']:
+            es = slice(self.edge_offsets[i], self.edge_offsets[i+1])
+            bs = slice(self.block_offsets[i], self.block_offsets[i+1])
+            lc.set_bblocks(a['edges'][es], (a['block_pbin'][bins], a['block_val'][bs],
+                                            a['block_val_error'][bs], a['edge_index'][es]))
+            lc.gamma_value, lc.p0_value = source['gamma_value'], source['p0_value']
+        return lc
+
+    def load(self, names=None):
+        """
+        Return list of LightCurves (all or selected by name)
+        """
+        if names is None:
+            return [self[i] for i in range(len(self))]
+        return [self[name] for name in names]
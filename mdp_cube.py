@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+import LC
+from Quiescent import quiescent_flare_population
+from FlareDetectionTony import fluence_table, ComputeMDP99, FLUENCE_COLUMNS
+
+import logging
+logging.basicConfig(level=logging.ERROR) #see LC.py
+
+"""
+MDP99 grid of all flares
+--------------------------------------------------------------------------
+MDP99 only depends on source and background counts of a flare, i.e. on its mean flux and
+duration (fluence table, computed once) and on COSI_bkg_rate, average_mu and the LAT -> COSI
+count rate factor of the assumed spectrum (e.g. 'softer +0.5'). Instead of one full run of the
+fluence pipeline and one csv per combination, ComputeMDP99 is broadcast over the whole grid:
+    mdp99[flare, bkg_rate, average_mu, shift]
+and saved as one .npz file with the flare table and the axes. For example:
+    fluences = fluence_population(cadence_df)
+    factors = count_rate_factors({0: pd.read_csv(f0), 0.5: pd.read_csv(f_softer)})
+    cube = mdp_cube(fluences, factors, bkg_rates=[20, 10, 1], average_mus=[0.1, 0.3, 0.5])
+    cube.save('mdp99_cube.npz')
+    df = MDPCube.load('mdp99_cube.npz').sel(bkg_rate=10, average_mu=0.3, shift=0.5)
+"""
+
+
+def fluence_population(cadence_df, names=None, factor=1, MJDREFI=51910, outlier_factor=100,
+                       time='s', **kwargs):
+    """
+    Fluence table (see FlareDetectionTony.fluence_table, without source counts) of the flares
+    of all sources, found with Quiescent.quiescent_flare_population (kwargs are passed on);
+    the light curves split there are reused, the cadence table is only split once
+    """
+    _, flares, sources = quiescent_flare_population(cadence_df, names=names, factor=factor,
+                                                    MJDREFI=MJDREFI,
+                                                    outlier_factor=outlier_factor,
+                                                    return_sources=True, **kwargs)
+    sources = {s[0]: s for s in sources}
+    tables = []
+    for name, group in flares.groupby('source_name', sort=False):
+        _, cadence, t, flux, flux_error = sources[name]
+        lc = LC.LightCurve(t, flux, flux_error, time_format='mjd', name=name, cadence=cadence,
+                           validate=False, copy=False)
+        table = fluence_table(lc, group, time=time)
+        table['quiescent_background'] = group['quiescent_background'].to_numpy()
+        tables.append(table)
+    if len(tables) == 0:
+        return pd.DataFrame(columns=FLUENCE_COLUMNS + ['quiescent_background'])
+    return pd.concat(tables, ignore_index=True)
+
+def count_rate_factors(factor_tables):
+    """
+    COSI count rate per unit LAT photon flux (Aeff_mean_LAT(cm2) * ph/s_ratio) of all sources
+    factor_tables: {shift: table like COSICSV/COSI_factors_all_*.csv (Name, ph/s_ratio,
+                    Aeff_mean_LAT(cm2))}, e.g. {0: nominal, 0.5: softer +0.5}
+    Returns pd.DataFrame (index: source name, one column per shift)
+    """
+    columns = {}
+    for shift, table in factor_tables.items():
+        factor = table['Aeff_mean_LAT(cm2)'].to_numpy(dtype=float) * \
+                 table['ph/s_ratio'].to_numpy(dtype=float)
+        factor = pd.Series(factor, index=table['Name'].to_numpy())
+        columns[shift] = factor[~factor.index.duplicated()] # first row of a source
+    return pd.DataFrame(columns)
+
+def mdp_cube(fluences, factors, bkg_rates, average_mus, shifts=None, arm_reduction=None):
+    """
+    MDP99 of all flares on the grid bkg_rates x average_mus x shifts
+    fluences: fluence table (source_name, mean_flux, duration), see fluence_population
+    factors: count rate factors (index: source name, columns: shifts), see count_rate_factors
+    shifts: columns of factors to use (default all)
+    arm_reduction: source counts are divided by it, one value per bkg_rate (default 1), e.g.
+                   1, 1.27, 3.22 for the ARM cuts of 20, 10, 1 ct/s
+    source_counts = mean_flux * factor * duration / arm_reduction
+    background_counts = bkg_rate * duration
+    Returns MDPCube
+    """
+    shifts = list(factors.columns) if shifts is None else list(shifts)
+    bkg_rates = np.asarray(bkg_rates, dtype=float)
+    average_mus = np.asarray(average_mus, dtype=float)
+    if arm_reduction is None:
+        arm_reduction = np.ones(len(bkg_rates))
+    arm_reduction = np.asarray(arm_reduction, dtype=float)
+    if len(arm_reduction) != len(bkg_rates):
+        raise ValueError('arm_reduction needs one value per bkg_rate')
+    # factor[flare, shift]; flares of sources without factor get np.nan
+    factor = factors.reindex(fluences['source_name'].to_numpy())[shifts].to_numpy(dtype=float)
+    duration = fluences['duration'].to_numpy(dtype=float)
+    counts = fluences['mean_flux'].to_numpy(dtype=float) * duration
+    # axes: flare, bkg_rate, average_mu, shift
+    src = (counts[:, None] * factor)[:, None, None, :] / arm_reduction[None, :, None, None]
+    bkg = (duration[:, None] * bkg_rates[None, :])[:, :, None, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mdp99 = ComputeMDP99(src, bkg, average_mus[None, None, :, None])
+    mdp99 = np.broadcast_to(mdp99, (len(duration), len(bkg_rates), len(average_mus),
+                                    len(shifts)))
+    return MDPCube(fluences, mdp99.astype(np.float32), factor, bkg_rates, average_mus,
+                   np.asarray(shifts, dtype=float), arm_reduction)
+
+
+class MDPCube:
+    '''
+    MDP99 Cube
+    ==========
+    mdp99[flare, bkg_rate, average_mu, shift] (float32) with the flare table (one row per
+    flare), count rate factor[flare, shift] and the grid axes
+    save()/load() as one .npz file, sel() gives a flat table of one grid point
+    '''
+    def __init__(self, flares, mdp99, factor, bkg_rates, average_mus, shifts, arm_reduction):
+        self.flares = flares.reset_index(drop=True)
+        self.mdp99 = mdp99
+        self.factor = factor
+        self.bkg_rates = bkg_rates
+        self.average_mus = average_mus
+        self.shifts = shifts
+        self.arm_reduction = arm_reduction
+
+    def __repr__(self):
+        return f'MDPCube (flares = {len(self.flares)}, bkg_rates = {self.bkg_rates.tolist()}, ' + \
+               f'average_mus = {self.average_mus.tolist()}, shifts = {self.shifts.tolist()})'
+
+    def index(self, axis, value):
+        ii = np.flatnonzero(np.isclose(axis, value))
+        if len(ii) == 0:
+            raise KeyError(str(value) + ' is not on the grid ' + str(list(axis)))
+        return ii[0]
+
+    def sel(self, bkg_rate, average_mu, shift=0):
+        """
+        Flare table with source_counts, background_counts and mdp99 of one grid point
+        """
+        b = self.index(self.bkg_rates, bkg_rate)
+        m = self.index(self.average_mus, average_mu)
+        s = self.index(self.shifts, shift)
+        table = self.flares.copy()
+        duration = table['duration'].to_numpy(dtype=float)
+        table['source_counts'] = table['mean_flux'].to_numpy(dtype=float) * duration * \
+                                 self.factor[:, s] / self.arm_reduction[b]
+        table['background_counts'] = self.bkg_rates[b] * duration
+        table['mdp99'] = self.mdp99[:, b, m, s]
+        return table
+
+    def save(self, path):
+        # flare table column by column (strings as unicode arrays), grid and cube
+        arrays = {'flare_' + key: (self.flares[key].to_numpy()
+                                   if pd.api.types.is_numeric_dtype(self.flares[key])
+                                   else self.flares[key].to_numpy(dtype=str))
+                  for key in self.flares.columns}
+        np.savez(path, mdp99=self.mdp99, factor=self.factor, bkg_rates=self.bkg_rates,
+                 average_mus=self.average_mus, shifts=self.shifts,
+                 arm_reduction=self.arm_reduction, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            flares = pd.DataFrame({key[len('flare_'):]: f[key] for key in f.files
+                                   if key.startswith('flare_')})
+            return cls(flares, f['mdp99'], f['factor'], f['bkg_rates'], f['average_mus'],
+                       f['shifts'], f['arm_reduction'])